@@ -0,0 +1,107 @@
+# coding: utf-8
+"""
+Local stand-in for the ArticleMeta article endpoint which injects latency and
+errors, to exercise the adaptive throttle and the circuit breaker of the
+fetches. Point ``articlemeta_url`` of the settings file to it, e.g.
+``http://127.0.0.1:8800/api/v1/article``.
+"""
+
+import time
+import random
+import argparse
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from urlparse import urlparse, parse_qs
+
+# a payload valid against the bundled Clarivate schema, so that the stub
+# exercises the fetches and not the rejections
+PAYLOAD = """<?xml version="1.0" encoding="utf-8"?>
+<articles dtd-version="1.12">
+<article article-type="research-article" lang_id="en"><front>
+<journal-meta><journal-title-group><journal-title>Stub</journal-title>
+</journal-title-group><issn>{issn}</issn>
+<publisher><publisher-name>Stub</publisher-name></publisher></journal-meta>
+<article-meta><unique-article-id>{code}</unique-article-id>
+<article-categories><subj-group><subject>Stub</subject></subj-group>
+</article-categories>
+<title-group><article-title>Stub article {code}</article-title></title-group>
+<pub-date pub-type="print"><year>2000</year></pub-date>
+</article-meta></front></article></articles>"""
+
+
+class StubConfig(object):
+    """
+    ``latency`` seconds (plus up to ``jitter``) before each response and
+    ``error_rate`` of responses 503. Can be changed while serving.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, payload=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload = payload or PAYLOAD
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=8800, host="127.0.0.1", config=None):
+    """
+    Serves the stub in a daemon thread. Returns the server, whose ``config``
+    attribute is the StubConfig.
+    """
+    config = config or StubConfig()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(config.latency + random.random() * config.jitter)
+            if random.random() < config.error_rate:
+                self.send_error(503, "Injected error")
+                return
+            params = parse_qs(urlparse(self.path).query)
+            code = params.get("code", ["S0000-00002000000000000"])[0]
+            body = config.payload.format(issn=code[1:10], code=code)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.config = config
+    thread = threading.Thread(target=server.serve_forever, name="articlemeta-stub")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ArticleMeta stub which injects latency and errors"
+    )
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Seconds")
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="Fraction of 503 responses"
+    )
+    args = parser.parse_args()
+
+    server = serve(
+        args.port, config=StubConfig(args.latency, args.jitter, args.error_rate)
+    )
+    print("Serving on http://127.0.0.1:%i/api/v1/article" % args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
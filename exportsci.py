@@ -3,26 +3,133 @@
 from datetime import datetime
 import os
 import argparse
+import functools
+import itertools
 import logging
 import shutil
+import time
+import json
+from collections import OrderedDict
 
+from bson import json_util
+from pymongo.errors import PyMongoError
+from multiprocessing.pool import ThreadPool
+
+import metrics
 import tools
 import utils
-from lxml import etree
 
 from utils import earlier_yyyymmdd
 
 
 logger = logging.getLogger(__name__)
-config = utils.Configuration.from_env()
-settings = dict(config.items())["main:exportsci"]
 
-FTP_HOST = settings["ftp_host"]
-FTP_USER = settings["ftp_user"]
-FTP_PASSWD = settings["ftp_passwd"]
-MONGODB_HOST = settings["mongodb_host"]
-MONGODB_SLAVEOK = bool(settings["mongodb_slaveok"])
-WOS_COLLECTIONS_ALLOWED = settings["wos_collections_allowed"].strip().split(",")
+
+class Settings(object):
+    """
+    Settings of the section ``main:exportsci`` of EXPORTSCI_SETTINGS_FILE,
+    which is only read when a setting is used, so that e.g. ``--help`` works
+    without it.
+    """
+
+    def __init__(self, section="main:exportsci"):
+        self.section = section
+
+    @utils.lazy_property
+    def items(self):
+        config = utils.Configuration.from_env()
+        return dict(config.items())[self.section]
+
+    @utils.lazy_property
+    def ftp_host(self):
+        return self.items["ftp_host"]
+
+    @utils.lazy_property
+    def ftp_user(self):
+        return self.items["ftp_user"]
+
+    @utils.lazy_property
+    def ftp_passwd(self):
+        return self.items["ftp_passwd"]
+
+    @utils.lazy_property
+    def mongodb_host(self):
+        return self.items["mongodb_host"]
+
+    @utils.lazy_property
+    def mongodb_slaveok(self):
+        return self.items["mongodb_slaveok"].strip().lower() in ("1", "true", "yes")
+
+    @utils.lazy_property
+    def mongodb_read_preference(self):
+        """
+        ``secondaryPreferred`` with mongodb_slaveok, unless the setting
+        mongodb_read_preference is given.
+        """
+        value = self.items.get("mongodb_read_preference", "").strip()
+        if not value and self.mongodb_slaveok:
+            value = "secondaryPreferred"
+        return value or None
+
+    @utils.lazy_property
+    def mongodb_read_pool_size(self):
+        return int(self.items.get("mongodb_read_pool_size", 100))
+
+    @utils.lazy_property
+    def mongodb_max_staleness_seconds(self):
+        value = self.items.get("mongodb_max_staleness_seconds", "").strip()
+        return int(value) if value else None
+
+    @utils.lazy_property
+    def wos_collections_allowed(self):
+        return self.items["wos_collections_allowed"].strip().split(",")
+
+    @utils.lazy_property
+    def ftp_blocksize(self):
+        return int(self.items.get("ftp_blocksize", tools.FTP_BLOCKSIZE))
+
+    @utils.lazy_property
+    def ftp_retries(self):
+        return int(self.items.get("ftp_retries", 3))
+
+    @utils.lazy_property
+    def articlemeta_url(self):
+        return self.items.get("articlemeta_url", "").strip() or None
+
+    @utils.lazy_property
+    def retention_days(self):
+        return int(self.items.get("retention_days", 0) or 0)
+
+    @utils.lazy_property
+    def retention_bytes(self):
+        return int(self.items.get("retention_bytes", 0) or 0)
+
+    @utils.lazy_property
+    def link_duplicate_zips(self):
+        value = self.items.get("link_duplicate_zips", "")
+        return value.strip().lower() in ("1", "true", "yes")
+
+    @utils.lazy_property
+    def zip_level(self):
+        return int(self.items.get("zip_level", tools.ZIP_LEVEL))
+
+    @utils.lazy_property
+    def zip_workers(self):
+        return int(self.items.get("zip_workers", tools.ZIP_WORKERS))
+
+
+SETTINGS = Settings()
+
+# directories whose files are subject to the retention settings
+OUTPUT_PATHS = [
+    "xml",
+    "zips",
+    "reports",
+    tools.XML_ERRORS_ROOT_PATH,
+    "collections_reports",
+    "ftp_manifests",
+    "artifacts",
+]
 
 
 def _config_logging(logging_level="INFO", logging_file=None):
@@ -49,7 +156,7 @@ def _config_logging(logging_level="INFO", logging_file=None):
     hl.setFormatter(formatter)
     hl.setLevel(allowed_levels.get(logging_level, "INFO"))
 
-    logger.addHandler(hl)
+    logger.addHandler(utils.AsyncHandler(hl))
 
     return logger
 
@@ -73,202 +180,1107 @@ def _get_collection_issns(collection):
     return collection_issns
 
 
-def run(collection, task="add", clean_garbage=False, normalize=True):
-    required_dirs = ["controller", "reports", "xml"]
-    working_dir = os.listdir(".")
-    logger.debug("Validating working directory %s" % working_dir)
-    for d in required_dirs:
-        if d not in working_dir:
-            logger.error("Working dir does not have {} directory".format(d))
-            exit()
+def _is_ahead(document):
+    return (
+        "v32" in document["article"]
+        and "ahead" in document["article"]["v32"][0]["_"].lower()
+    )
 
-    if clean_garbage:
-        logger.debug("Removing previous XML files")
-        os.system("rm -f xml/*.xml")
-        logger.debug("Removing previous zip files")
-        os.system("rm -f *.zip")
-        logger.debug("Removing previous error report files")
-        os.system("rm -f report/*errors.txt")
 
-    if task == "update":
-        logger.debug("Loading toupdate.txt ISSN's file from FTP controller directory")
-        tools.get_to_update_file_from_ftp(
-            ftp_host=FTP_HOST, user=FTP_USER, passwd=FTP_PASSWD
+def _rejection(textxml, errors):
+    """
+    Returns ``(checksum, errors)`` of an invalid payload, to quarantine its
+    document, or ``None``.
+    """
+    if tools.quarantinable(errors):
+        return tools.payload_checksum(textxml), list(errors)
+
+
+def _validate_document(xml_validator, document):
+    """
+    Returns ``(fragment, rejection)`` for ``document``: the serialized
+    ``<article>`` if it is valid, ``None`` otherwise, and the ``_rejection``
+    of its payload.
+    """
+    try:
+        # skip ahead documents
+        if _is_ahead(document):
+            return None, None
+
+        textxml = xml_validator.get_xml(document["collection"], document["code"])
+        validated_xml = xml_validator.validate_payload(
+            document["collection"], document["code"], textxml
         )
-        issns = tools.load_journals_list(journals_file="controller/toupdate.txt")
-    elif task == "add":
-        logger.debug("Loading keepinto.txt ISSN's file from FTP controller directory")
-        tools.get_keep_into_file_from_ftp(
-            ftp_host=FTP_HOST, user=FTP_USER, passwd=FTP_PASSWD
+        if validated_xml.errors:
+            return None, _rejection(textxml, validated_xml.errors)
+        return tools.article_fragment(validated_xml.tree), None
+    except tools.CircuitOpen:
+        raise
+    except Exception as exc:
+        logger.exception(
+            'unhandled exception during validation of "%s"', document["code"]
         )
-        issns = tools.load_journals_list(journals_file="controller/keepinto.txt")
+    return None, None
 
-    collection_issns = _get_collection_issns(collection)
-    valid_issns = set(issns) & set(collection_issns)
-    if not valid_issns:
-        logger.error("No valid issns to process")
-        exit()
 
-    # Setup a connection to SciELO Network Collection
-    logger.debug("Connecting to mongodb with DataHandler thru %s" % (MONGODB_HOST))
-    dh = tools.DataHandler(MONGODB_HOST)
-    collections = dh.load_collections_metadata()
+def _validate_item(xml_validator, item):
+    total, current, document = item
+    fragment, rejection = _validate_document(xml_validator, document)
+    return total, document, fragment, rejection
 
-    # logger.debug("Remove previous inbound files")
-    # tools.remove_previous_unbound_files_from_ftp(ftp_host=FTP_HOST,
-    #                              user=FTP_USER,
-    #                              passwd=FTP_PASSWD)
 
-    # logger.debug("Syncing XML's status according to WoS validated files")
-    # tools.get_sync_file_from_ftp(ftp_host=FTP_HOST,
-    #                              user=FTP_USER,
-    #                              passwd=FTP_PASSWD)
+def _fetch_item(xml_validator, item):
+    total, current, document = item
+    textxml = None
+    try:
+        # skip ahead documents
+        if not _is_ahead(document):
+            textxml = xml_validator.get_xml(document["collection"], document["code"])
+    except tools.CircuitOpen:
+        raise
+    except Exception as exc:
+        logger.exception(
+            'unhandled exception during fetching of "%s"', document["code"]
+        )
+    return total, document, textxml
+
+
+def _validate_fetched(validation_pool, fetched):
+    payloads = [
+        (document["collection"], document["code"], textxml)
+        for total, document, textxml in fetched
+        if textxml is not None
+    ]
+    results = validation_pool.imap(payloads)
+    for total, document, textxml in fetched:
+        fragment = None
+        rejection = None
+        if textxml is not None:
+            code, fragment, errors = next(results)
+            if errors:
+                logger.debug("{} - {} errors".format(code, len(errors)))
+                rejection = _rejection(textxml, errors)
+        yield total, document, fragment, rejection
+
+
+def validate_documents(xml_validator, documents, workers=1, validation_pool=None):
+    """
+    Yields ``(total, document, fragment, rejection)`` for each item of
+    ``documents``, keeping its order. ``fragment`` is the serialized
+    ``<article>`` of the valid documents and ``None`` for the others.
+    ``rejection`` is ``(checksum, errors)`` of the invalid payloads.
+
+    With ``workers > 1`` the ArticleMeta requests run in a thread pool.
+    Given a ``tools.ValidationPool``, the threads only fetch the payloads and
+    the parsing and schema validation run in its processes.
+    ``documents`` is consumed in batches so that only a bounded number of
+    documents is loaded from MongoDB at a time.
+    Raises ``tools.CircuitOpen`` if ArticleMeta becomes unhealthy.
+    """
+    if validation_pool is None:
+        stage = functools.partial(_validate_item, xml_validator)
+        batch_size = workers * 4
+    else:
+        stage = functools.partial(_fetch_item, xml_validator)
+        batch_size = max(workers, validation_pool.processes) * 4
 
-    # dh.sync_sent_documents(remove_origin=clean_garbage)
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        documents = iter(documents)
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                break
+            if pool is None:
+                results = [stage(item) for item in batch]
+            else:
+                results = pool.imap(stage, batch)
+            if validation_pool is not None:
+                results = _validate_fetched(validation_pool, list(results))
+            for result in results:
+                yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _part_name(filename, part):
+    name, ext = os.path.splitext(filename)
+    return "{}_{:02d}{}".format(name, part, ext)
+
+
+def _pack_bundle(bundle):
+    """
+    Writes and zips ``bundle`` (xml file name, zip file name, pids file name,
+    fragments, pids and exports). Returns the zip file name or ``None``.
+    """
+    xml_file_name, zip_filename, pids_filename, fragments = bundle[:4]
+    try:
+        tools.write_bundle(xml_file_name, fragments)
+    except Exception as exc:
+        logger.error("Unable to generate XML {}: {}".format(xml_file_name, exc))
+        return None
 
-    # logger.debug("Creating file with a list of documents to be removed from WoS")
-    # tools.get_take_off_files_from_ftp(ftp_host=FTP_HOST,
-    #                                   user=FTP_USER,
-    #                                   passwd=FTP_PASSWD,
-    #                                   remove_origin=clean_garbage)
+    try:
+        # zipping files
+        return tools.packing_zip(
+            xml_file_name,
+            None,
+            None,
+            zip_filename,
+            level=SETTINGS.zip_level,
+            workers=SETTINGS.zip_workers,
+        )
+    except Exception as exc:
+        logger.error("Unable to generate zip for {}: {}".format(xml_file_name, exc))
 
-    # ids_to_remove = dh.load_pids_list_to_be_removed()
 
-    # tools.send_take_off_files_to_ftp(ftp_host=FTP_HOST,
-    #                                  user=FTP_USER,
-    #                                  passwd=FTP_PASSWD,
-    #                                  remove_origin=clean_garbage)
+def _pack_bundles(bundles, workers=1):
+    """
+    Writes and zips ``bundles``, ``workers`` at a time (zlib releases the GIL
+    while compressing). Returns the zip file names, ``None`` for failures.
+    """
+    workers = min(workers, len(bundles))
+    if workers <= 1:
+        return [_pack_bundle(bundle) for bundle in bundles]
 
-    logger.debug("Defining document types elegible to send to SCI")
-    dh.set_elegible_document_types()
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(_pack_bundle, bundles)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _send_bundle(
+    dh,
+    zipped_file_name,
+    pids_filename,
+    pids,
+    manifest=None,
+    exports=None,
+    artifacts=None,
+):
+    """
+    Sends ``zipped_file_name`` to the FTP and, once it is sent, marks its
+    ``pids`` as sent to WoS and records its ``exports``, the ``(_id,
+    checksum)`` of each ``<article>``, in the export ledger. The zip and the
+    pids file are kept in ``artifacts``. Returns whether it was sent.
+    """
+    try:
+        # sending to ftp.scielo.br
+        tools.send_to_ftp(
+            zipped_file_name,
+            ftp_host=SETTINGS.ftp_host,
+            user=SETTINGS.ftp_user,
+            passwd=SETTINGS.ftp_passwd,
+            send_reports=False,
+            blocksize=SETTINGS.ftp_blocksize,
+            manifest=manifest,
+            retries=SETTINGS.ftp_retries,
+        )
+    except Exception as exc:
+        logger.error("Unable to ftp {}: {}".format(zipped_file_name, exc))
+        return False
 
-    xml_validator = tools.XMLValidator()
-    now = datetime.now().isoformat()[0:10]
+    dh.mark_documents_as_sent_to_wos(pids)
+    if exports:
+        try:
+            dh.record_exports(exports)
+        except PyMongoError:
+            logger.exception("Unable to record the exports of %s", zipped_file_name)
+    with open(pids_filename, "w") as fp:
+        fp.write("\n".join(pids))
+    if artifacts is None:
+        shutil.move(zipped_file_name, "zips")
+    else:
+        artifacts.add("pids", pids_filename)
+        artifacts.store_zip(zipped_file_name)
+    return True
+
+
+class Throughput(object):
+    """
+    Documents, fetched bytes and rejected documents of an ISSN run, and the
+    PIDs of the valid documents which could not be packed or sent.
+    """
+
+    def __init__(self, issn, xml_validator):
+        self.issn = issn
+        self.documents = 0
+        self.valid = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.paused = False
+        self.unsent = []
+        self._xml_validator = xml_validator
+        self._fetched_bytes = xml_validator.fetched_bytes
+        self._started = time.time()
+        self._logged = self._started
+
+    def add(self, fragment):
+        self.documents += 1
+        if fragment:
+            self.valid += 1
+
+    def log_progress(self, total, interval=30):
+        """
+        Logs the progress of the ISSN at most once every ``interval``
+        seconds, instead of once per document.
+        """
+        now = time.time()
+        if now - self._logged < interval:
+            return
+        self._logged = now
+        logger.info(
+            "%s - total xmls: %s, processed: %s, valid: %s",
+            self.issn,
+            total,
+            self.documents,
+            self.valid,
+        )
 
-    # Loading XML files
-    for issn in valid_issns:
+    def stop(self):
+        self.elapsed = time.time() - self._started
+        self.bytes = self._xml_validator.fetched_bytes - self._fetched_bytes
+
+    @property
+    def rejected_rate(self):
+        if not self.documents:
+            return 0.0
+        return float(self.documents - self.valid) / self.documents
+
+    def __str__(self):
+        elapsed = self.elapsed or 1e-9
+        return (
+            "{}: {} documents, {} valid, {:.1%} rejected, "
+            "{:.1f} documents/s, {:.0f} bytes/s{}"
+        ).format(
+            self.issn,
+            self.documents,
+            self.valid,
+            self.rejected_rate,
+            self.documents / elapsed,
+            self.bytes / elapsed,
+            ", paused" if self.paused else "",
+        )
+
+
+class PausedIssns(object):
+    """
+    ISSNs whose export was interrupted because ArticleMeta was unhealthy, one
+    per line in ``filename``, so that the next run exports them first.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._issns = []
+        if os.path.isfile(filename):
+            with open(filename, "r") as fp:
+                self._issns = [line.strip() for line in fp if line.strip()]
+
+    def __iter__(self):
+        return iter(list(self._issns))
+
+    def __contains__(self, issn):
+        return issn in self._issns
+
+    def add(self, issn):
+        if issn not in self._issns:
+            self._issns.append(issn)
+            self.save()
 
-        # if issn in ids_to_remove:
-        #     logger.debug(
-        #         "Issn {0} is available in the takeoff and keepinto file. For now this ISSN was ignored, and will not be send to WoS until it is removed from the takeoff file.".format(
-        #             issn
-        #         )
-        #     )
-        #     continue
+    def discard(self, issn):
+        if issn in self._issns:
+            self._issns.remove(issn)
+            self.save()
 
+    def save(self):
+        with open(self.filename, "w") as fp:
+            fp.write("".join("{}\n".format(issn) for issn in self._issns))
+
+
+class ThroughputHistory(object):
+    """
+    Moving average of the documents per second of the past runs of a
+    collection and task, stored as JSON in ``filename``.
+    """
+
+    def __init__(self, filename, weight=0.3):
+        self.filename = filename
+        self.weight = weight
+        self.documents_per_second = None
+        try:
+            with open(filename, "r") as fp:
+                self.documents_per_second = json.load(fp)["documents_per_second"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def add(self, throughputs):
+        documents = sum(t.documents for t in throughputs)
+        elapsed = sum(t.elapsed for t in throughputs)
+        if not documents or not elapsed:
+            return
+        rate = documents / elapsed
+        if self.documents_per_second:
+            rate = self.weight * rate + (1 - self.weight) * self.documents_per_second
+        self.documents_per_second = rate
+        with open(self.filename, "w") as fp:
+            json.dump({"documents_per_second": rate}, fp)
+
+
+class ExecutionPlan(object):
+    """
+    Documents expected for each ISSN of a run, in decreasing order of cost,
+    and the time estimated from the throughput of past runs.
+    """
+
+    def __init__(self, counts, documents_per_second=None):
+        self.counts = counts
+        self.documents_per_second = documents_per_second
+
+    @property
+    def issns(self):
+        """
+        ISSNs which have documents to process, the largest first.
+        """
+        return [
+            issn
+            for issn in sorted(self.counts, key=lambda i: (-self.counts[i], i))
+            if self.counts[issn]
+        ]
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def estimated_seconds(self, issn=None):
+        if not self.documents_per_second:
+            return None
+        documents = self.total if issn is None else self.counts[issn]
+        return documents / self.documents_per_second
+
+    def __str__(self):
+        lines = []
+        for issn in self.issns:
+            lines.append("{}: {} documents".format(issn, self.counts[issn]))
+        summary = "{} documents in {} ISSNs".format(self.total, len(self.issns))
+        seconds = self.estimated_seconds()
+        if seconds is not None:
+            summary += ", estimated in {:.0f}s ({:.1f} documents/s)".format(
+                seconds, self.documents_per_second
+            )
+        lines.append(summary)
+        return "\n".join(lines)
+
+
+def plan_run(dh, collection, task, issns, quarantine=True):
+    """
+    Counts the documents of each one of ``issns`` to be exported by ``task``
+    with a single aggregation and returns the ExecutionPlan.
+    For ``update`` the counts do not consider the processing date, so they
+    are an upper bound.
+    """
+    if task == "update":
+        fltr = dh.sent_to_wos_filter()
+    else:
+        fltr = dh.not_sent_filter(
+            SETTINGS.wos_collections_allowed,
+            publication_year=2002,
+            quarantined=not quarantine,
+        )
+    history = ThroughputHistory(_throughput_history_filename(collection, task))
+    return ExecutionPlan(
+        dh.count_by_code_title(fltr, issns), history.documents_per_second
+    )
+
+
+def _throughput_history_filename(collection, task):
+    return "controller/throughput_{}_{}.json".format(collection, task)
+
+
+class Exporter(object):
+    """
+    Fetches, validates, packs and sends the documents of the ISSNs of a
+    collection, for the task ``add`` or ``update``.
+
+    With ``quarantine``, the documents of ``add`` whose payload is invalid
+    are quarantined and not selected again until they are processed again.
+    The checksum of the ``<article>`` sent is recorded in an export ledger,
+    and unless ``resend_unchanged``, ``update`` only sends the documents
+    whose ``<article>`` changed since then.
+
+    The ArticleMeta requests go through an AdaptiveThrottle. When its
+    circuit opens, the ISSN being exported is paused: the documents
+    validated so far are sent and the ISSN is recorded in ``paused``.
+    """
+
+    def __init__(
+        self,
+        dh,
+        collection,
+        task="add",
+        workers=1,
+        processes=0,
+        dry_run=False,
+        max_articles=0,
+        max_bytes=0,
+        quarantine=True,
+        resend_unchanged=False,
+    ):
+        self.dh = dh
+        self.collection = collection
+        self.task = task
+        self.workers = workers
+        self.dry_run = dry_run
+        self.max_articles = max_articles
+        self.max_bytes = max_bytes
+        self.quarantine = quarantine and task == "add"
+        self.resend_unchanged = resend_unchanged
+        self.throughputs = []
+        # a dry run does not write the error reports either
+        self.xml_validator = tools.XMLValidator(
+            pool_size=max(workers, 10),
+            articlemeta_url=SETTINGS.articlemeta_url,
+            report_errors=not dry_run,
+        )
+        self.paused = PausedIssns(
+            "controller/paused_{}_{}.txt".format(collection, task)
+        )
+        self.validation_pool = None
+        if processes > 0:
+            self.validation_pool = tools.ValidationPool(
+                processes, self.xml_validator.xsd_filename, report_errors=not dry_run
+            )
+        now = datetime.now().isoformat()[0:10]
+        self.upload_manifest = tools.UploadManifest("ftp_manifests/{}.json".format(now))
+        self.artifacts = tools.ArtifactStore(
+            link_duplicates=SETTINGS.link_duplicate_zips
+        )
+
+    def collect_garbage(self):
+        """
+        Enforces the retention settings on the output directories, except in
+        a dry run.
+        """
+        if self.dry_run:
+            return
+        if SETTINGS.retention_days or SETTINGS.retention_bytes:
+            self.artifacts.collect(
+                OUTPUT_PATHS, SETTINGS.retention_days, SETTINGS.retention_bytes
+            )
+
+    def wait_for_articlemeta(self):
+        self.xml_validator.throttle.wait()
+
+    def resume_paused(self):
+        """
+        Exports again the paused ISSNs, waiting for ArticleMeta to be reached.
+        """
+        for issn in self.paused:
+            self.wait_for_articlemeta()
+            self.export_issn(issn)
+
+    def close(self):
+        if self.validation_pool is not None:
+            self.validation_pool.close()
+        self.collect_garbage()
+
+    def filenames(self, issn, stamp):
+        """
+        Returns the names of the XML, zip and pids files of ``issn`` for the
+        task, identified by ``stamp`` (the date of the run).
+        """
         folders = [
             "xml",
-            collection,
+            self.collection,
             issn,
         ]
         issn_xml_path = "/".join(folders)
         if not os.path.exists(issn_xml_path):
             os.makedirs(issn_xml_path)
 
+        prefix = "COR_" if self.task == "update" else ""
+        xml_file_name = "{}/SciELO_{}{}_{}.xml".format(
+            issn_xml_path, prefix, issn, stamp
+        )
+        pids_filename = "{}/pids_{}{}_{}.txt".format(issn_xml_path, prefix, issn, stamp)
+        zip_filename = "scielo_{}_{}.zip".format(stamp, issn)
+        return xml_file_name, zip_filename, pids_filename
+
+    def export_issn(self, issn):
+        """
+        Exports the documents of ``issn`` selected by the task.
+        Returns its Throughput.
+        """
+        dh = self.dh
         proc_date_ctrl = ProcessingDateController(issn)
 
-        if task == "update":
+        if self.task == "update":
             try:
                 documents = dh.sent_to_wos_with_proc_date(
                     issn,
                     proc_date_ctrl.from_date,
                 )
-            except:
+            except Exception:
+                logger.exception(
+                    "%s - unable to select by processing date, selecting all", issn
+                )
                 documents = None
             if documents is None:
                 documents = dh.sent_to_wos(issn)
-
-            xml_file_name = "{}/SciELO_COR_{}_{}.xml".format(issn_xml_path, issn, now)
-            pids_filename = "{}/pids_COR_{}_{}.txt".format(issn_xml_path, issn, now)
-        elif task == "add":
+        elif self.task == "add":
             try:
                 documents = dh.not_sent_with_proc_date(
-                    WOS_COLLECTIONS_ALLOWED,
+                    SETTINGS.wos_collections_allowed,
                     issn,
                     publication_year=2002,
+                    quarantined=not self.quarantine,
+                )
+            except Exception:
+                logger.exception(
+                    "%s - unable to select by processing date, selecting all", issn
                 )
-            except:
                 documents = None
             if documents is None:
                 documents = dh.not_sent(
-                    WOS_COLLECTIONS_ALLOWED, issn, publication_year=2002
+                    SETTINGS.wos_collections_allowed,
+                    issn,
+                    publication_year=2002,
+                    quarantined=not self.quarantine,
                 )
-            xml_file_name = "{}/SciELO_{}_{}.xml".format(issn_xml_path, issn, now)
-            pids_filename = "{}/pids_{}_{}.txt".format(issn_xml_path, issn, now)
-
-        nsmap = {
-            "xml": "http://www.w3.org/XML/1998/namespace",
-            "xlink": "http://www.w3.org/1999/xlink",
-        }
-        global_xml = etree.Element("articles", nsmap=nsmap)
-        global_xml.set("dtd-version", "1.12")
-        global_xml.set(
-            "{http://www.w3.org/2001/XMLSchema-instance}noNamespaceSchemaLocation",
-            "Clarivate_publishing_1.12.xsd",
-        )
 
+        now = datetime.now().isoformat()[0:10]
+        return self.export_documents(issn, documents, *self.filenames(issn, now))
+
+    def export_documents(
+        self, issn, documents, xml_file_name, zip_filename, pids_filename
+    ):
+        """
+        Validates ``documents`` (``[total, i, document]`` items) of ``issn``,
+        writes the valid ones in ``xml_file_name``, zips them in
+        ``zip_filename``, sends and marks them as sent, recording their PIDs
+        in ``pids_filename``.
+        Returns the Throughput of the validation.
+        """
+        dh = self.dh
+        xml_validator = self.xml_validator
+        metrics.CURRENT_ISSN.set_only(1, collection=self.collection, issn=issn)
+        throughput = Throughput(issn, xml_validator)
+        fragments = []
         pids = []
-        for total, current, document in documents:
-            logger.info("{} - total xmls: {}".format(issn, total))
+        exports = []
+        unchanged = 0
+        rejections = []
+        try:
+            for total, document, fragment, rejection in validate_documents(
+                xml_validator, documents, self.workers, self.validation_pool
+            ):
+                throughput.add(fragment)
+                throughput.log_progress(total)
+                if fragment:
+                    metrics.DOCUMENTS_VALIDATED.inc(issn=issn)
+                    checksum = tools.payload_checksum(fragment)
+                    if (
+                        self.task == "update"
+                        and not self.resend_unchanged
+                        and dh.is_exported(document, checksum)
+                    ):
+                        metrics.DOCUMENTS_UNCHANGED.inc(issn=issn)
+                        unchanged += 1
+                        continue
+                    fragments.append(fragment)
+                    pids.append(document["code"])
+                    exports.append((document["_id"], checksum))
+                else:
+                    metrics.DOCUMENTS_REJECTED.inc(issn=issn)
+                    if rejection is not None:
+                        rejections.append((document,) + rejection)
+        except tools.CircuitOpen:
+            logger.warning("%s - paused: ArticleMeta is unhealthy", issn)
+            throughput.paused = True
+            if not self.dry_run:
+                self.paused.add(issn)
+        else:
+            if not self.dry_run:
+                self.paused.discard(issn)
+
+        throughput.stop()
+        self.throughputs.append(throughput)
+        logger.info(str(throughput))
+        logger.info(
+            "{} - articlemeta connections: {}".format(
+                issn, xml_validator.connection_stats
+            )
+        )
 
-            try:
-                # skip ahead documents
-                if (
-                    "v32" in document["article"]
-                    and "ahead" in document["article"]["v32"][0]["_"].lower()
-                ):
-                    continue
-
-                xml = xml_validator.validate_xml(
-                    document["collection"], document["code"]
-                )
+        if unchanged:
+            logger.info("{} - unchanged, not sent again: {}".format(issn, unchanged))
 
-                if xml:
-                    global_xml.append(xml.find("article"))
-                    pids.append(document["code"])
-            except Exception as exc:
-                logger.exception(
-                    'unhandled exception during validation of "%s"', document["code"]
-                )
+        if self.dry_run:
+            # validate only: no packing, upload or marking
+            return throughput
+
+        if self.quarantine and rejections:
+            logger.info("{} - quarantined: {}".format(issn, len(rejections)))
+            try:
+                dh.quarantine_documents(rejections)
+            except PyMongoError:
+                logger.exception("Unable to quarantine the invalid documents")
 
         if not pids:
-            logger.error("No valid xml")
-            continue
+            if not unchanged:
+                logger.error("No valid xml")
+            return throughput
 
-        # Convertendo XML para texto
         logger.info("{} - total valid xmls: {}".format(issn, len(pids)))
-        try:
-            textxml = etree.tostring(global_xml, encoding="utf-8", method="xml")
-        except Exception as exc:
-            logger.error("Unable to generate XML {}: {}".format(xml_file_name, exc))
-            continue
+        chunks = list(
+            tools.bundle_chunks(
+                fragments, pids, exports, self.max_articles, self.max_bytes
+            )
+        )
+        bundles = []
+        for part, (chunk_fragments, chunk_pids, chunk_exports) in enumerate(chunks, 1):
+            names = [xml_file_name, zip_filename, pids_filename]
+            if len(chunks) > 1:
+                names = [_part_name(name, part) for name in names]
+            bundles.append(names + [chunk_fragments, chunk_pids, chunk_exports])
+
+        # Convertendo XML para texto e compactando
+        packed = _pack_bundles(bundles, self.workers)
+
+        sent = False
+        for zipped_file_name, bundle in zip(packed, bundles):
+            (
+                xml_file_name,
+                zip_filename,
+                pids_filename,
+                fragments,
+                pids,
+                exports,
+            ) = bundle
+            self.artifacts.add("xml", xml_file_name, issn=issn)
+            if not zipped_file_name:
+                throughput.unsent.extend(pids)
+                continue
+            if _send_bundle(
+                dh,
+                zipped_file_name,
+                pids_filename,
+                pids,
+                self.upload_manifest,
+                exports,
+                self.artifacts,
+            ):
+                sent = True
+            else:
+                throughput.unsent.extend(pids)
+                self.artifacts.add("zip", zipped_file_name, issn=issn, sent=False)
+
+        if sent:
+            try:
+                tools.send_collections_reports(
+                    SETTINGS.ftp_host, SETTINGS.ftp_user, SETTINGS.ftp_passwd
+                )
+            except Exception as exc:
+                logger.error("Unable to ftp the collections reports: {}".format(exc))
+        return throughput
+
+
+# fields written by the export itself, whose changes are not exported again
+OWN_FIELDS = ("sent_wos", "wos_export", "wos_quarantine")
+
+
+def _is_own_change(change):
+    """
+    Returns whether ``change`` is an update which only touched OWN_FIELDS,
+    e.g. the record of an export in the ledger.
+    """
+    if change.get("operationType") != "update":
+        return False
+    description = change.get("updateDescription") or {}
+    fields = list(description.get("updatedFields") or {}) + list(
+        description.get("removedFields") or []
+    )
+    return bool(fields) and all(field.split(".")[0] in OWN_FIELDS for field in fields)
+
+
+class ExportDaemon(object):
+    """
+    Watches the changes of the articles of ``issns`` and exports the
+    eligible ones, in bundles per ISSN, when ``max_documents`` are buffered
+    or ``max_wait`` seconds after the first one was buffered.
+
+    The resume token of the change stream is saved once nothing is left in
+    the buffers, so a restart resumes from there. The documents which could
+    not be sent are buffered again and retried ``max_wait`` seconds later.
+    Without a token, or if it expired, all the documents of the ISSNs are
+    exported first.
+    """
+
+    def __init__(self, exporter, issns, max_documents=500, max_wait=600):
+        self.exporter = exporter
+        self.issns = set(issns)
+        self.max_documents = max_documents
+        self.max_wait = max_wait
+        self._buffers = {}
+        self._buffered_at = {}
+        # ISSNs whose buffer holds documents which could not be sent
+        self._retrying = set()
+        self._token_filename = "controller/change_stream_{}_{}.json".format(
+            exporter.collection, exporter.task
+        )
+
+    def _filter(self):
+        if self.exporter.task == "update":
+            fltr = self.exporter.dh.sent_to_wos_filter()
         else:
-            with open(xml_file_name, "wb") as fp:
-                fp.write(textxml)
+            # the quarantined documents are skipped by ``add``
+            fltr = self.exporter.dh.not_sent_filter(
+                SETTINGS.wos_collections_allowed,
+                publication_year=2002,
+                quarantined=True,
+            )
+        fltr["code_title"] = {"$in": sorted(self.issns)}
+        return fltr
 
+    def _load_token(self):
         try:
-            # zipping files
-            now = datetime.now().isoformat()[0:10]
-            zip_filename = "scielo_{}_{}.zip".format(now, issn)
-            zipped_file_name = tools.packing_zip(
-                xml_file_name, None, None, zip_filename
+            with open(self._token_filename, "r") as fp:
+                return json_util.loads(fp.read())
+        except (IOError, ValueError):
+            return None
+
+    def _save_token(self, token):
+        if self.exporter.dry_run:
+            # the next run must not skip the changes only validated
+            return
+        with open(self._token_filename, "w") as fp:
+            fp.write(json_util.dumps(token))
+
+    def _issn(self, document):
+        code_title = document.get("code_title")
+        if not isinstance(code_title, list):
+            code_title = [code_title]
+        for issn in code_title:
+            if issn in self.issns:
+                return issn
+
+    def add(self, document):
+        issn = self._issn(document)
+        if issn is None:
+            return
+        if _is_ahead(document):
+            return
+        if self.exporter.quarantine and self.exporter.dh.is_quarantined(document):
+            # including the change made by quarantining it
+            return
+        buffered = self._buffers.setdefault(issn, OrderedDict())
+        self._buffered_at.setdefault(issn, time.time())
+        buffered[document["code"]] = document
+
+    def due(self):
+        """
+        ISSNs whose buffer is full or older than ``max_wait``.
+        """
+        now = time.time()
+        return [
+            issn
+            for issn, buffered in self._buffers.items()
+            if (len(buffered) >= self.max_documents and issn not in self._retrying)
+            or now - self._buffered_at[issn] >= self.max_wait
+        ]
+
+    def flush(self, issn):
+        buffered = self._buffers.pop(issn, {})
+        self._buffered_at.pop(issn, None)
+        self._retrying.discard(issn)
+        if not buffered:
+            return
+        total = len(buffered)
+        documents = [
+            [total, i, document] for i, document in enumerate(buffered.values(), 1)
+        ]
+        stamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        logger.info("{} - flushing {} documents".format(issn, total))
+        # one run per flush, so that the files of the previous flushes are
+        # subject to the retention
+        self.exporter.artifacts.start_run()
+        throughput = self.exporter.export_documents(
+            issn, documents, *self.exporter.filenames(issn, stamp)
+        )
+        # the daemon does not report the throughput history
+        del self.exporter.throughputs[:]
+
+        unsent = set(throughput.unsent)
+        # validated in order, so the ones left when ArticleMeta became
+        # unhealthy are the last ones
+        unsent.update(
+            document["code"] for _, _, document in documents[throughput.documents :]
+        )
+        if unsent:
+            # buffered again, so that the resume token is not saved past them
+            logger.warning(
+                "{} - {} documents not sent, buffered again".format(issn, len(unsent))
             )
-        except Exception as exc:
-            logger.error("Unable to generate zip for {}: {}".format(xml_file_name, exc))
-            continue
+            rebuffered = self._buffers.setdefault(issn, OrderedDict())
+            self._buffered_at.setdefault(issn, time.time())
+            self._retrying.add(issn)
+            for code, document in buffered.items():
+                if code in unsent:
+                    rebuffered.setdefault(code, document)
+
+    def flush_all(self):
+        for issn in list(self._buffers):
+            self.flush(issn)
+
+    def catch_up(self, issns):
+        for issn in issns:
+            self.exporter.wait_for_articlemeta()
+            self.exporter.export_issn(issn)
+
+    def run(self, catch_up_issns=None):
+        dh = self.exporter.dh
+        token = self._load_token()
+        stream = None
+        if token is not None:
+            try:
+                stream = dh.watch_articles(self._filter(), resume_after=token)
+            except PyMongoError:
+                logger.exception("Unable to resume the change stream, catching up")
+        if stream is None:
+            # opened before catching up, so the changes made meanwhile are
+            # read from the stream afterwards
+            stream = dh.watch_articles(self._filter())
+            try:
+                self.catch_up(catch_up_issns or self.issns)
+            except BaseException:
+                stream.close()
+                raise
 
+        last_token = None
+        elegible_at = time.time()
         try:
-            # sending to ftp.scielo.br
-            tools.send_to_ftp(
-                zipped_file_name, ftp_host=FTP_HOST, user=FTP_USER, passwd=FTP_PASSWD
-            )
-        except Exception as exc:
-            logger.error("Unable to ftp {}: {}".format(zipped_file_name, exc))
-        else:
-            dh.mark_documents_as_sent_to_wos(pids)
-            with open(pids_filename, "w") as fp:
-                fp.write("\n".join(pids))
-            shutil.move(zipped_file_name, "zips")
+            with stream:
+                while True:
+                    change = stream.try_next()
+                    if change is not None:
+                        last_token = change["_id"]
+                        if change.get("fullDocument") and not _is_own_change(change):
+                            self.add(change["fullDocument"])
+                    for issn in self.due():
+                        self.flush(issn)
+                    if last_token is not None and not self._buffers:
+                        self._save_token(last_token)
+                        last_token = None
+                    if time.time() - elegible_at >= self.max_wait:
+                        # new articles become elegible in a later change
+                        if not self.exporter.dry_run:
+                            dh.set_elegible_document_types()
+                        self.exporter.collect_garbage()
+                        if not self._buffers:
+                            self.exporter.resume_paused()
+                        elegible_at = time.time()
+        except KeyboardInterrupt:
+            logger.info("Stopping: flushing the buffered documents")
+            self.flush_all()
+            if last_token is not None and not self._buffers:
+                self._save_token(last_token)
+
+
+def run(
+    collection,
+    task="add",
+    clean_garbage=False,
+    normalize=True,
+    workers=1,
+    processes=0,
+    dry_run=False,
+    max_articles=0,
+    max_bytes=0,
+    plan_only=False,
+    profile=None,
+    trace_memory=None,
+    daemon=False,
+    flush_documents=500,
+    flush_seconds=600,
+    sync_sent=False,
+    quarantine=True,
+    resend_unchanged=False,
+):
+    required_dirs = ["controller", "reports", "xml"]
+    working_dir = os.listdir(".")
+    logger.debug("Validating working directory %s" % working_dir)
+    for d in required_dirs:
+        if d not in working_dir:
+            logger.error("Working dir does not have {} directory".format(d))
+            exit()
+
+    if profile and (workers > 1 or processes > 0 or SETTINGS.zip_workers > 1):
+        # cProfile only profiles the thread which enables it
+        logger.warning("Profiling: running in a single thread and process")
+        workers, processes = 1, 0
+        SETTINGS.zip_workers = 1
+    elif trace_memory and processes > 0 and utils.tracemalloc is not None:
+        # tracemalloc does not trace the validation processes
+        logger.warning("Tracing memory: validating in the fetching threads")
+        processes = 0
+
+    if clean_garbage and dry_run:
+        logger.warning("Dry run: not removing the previous files")
+    elif clean_garbage:
+        logger.debug("Removing previous XML files")
+        tools.remove_files("xml", "*.xml")
+        logger.debug("Removing previous zip files")
+        tools.remove_files(".", "*.zip", recursive=False)
+        logger.debug("Removing previous error report files")
+        tools.remove_files("reports", "*errors.txt")
+
+    if task == "update":
+        logger.debug("Loading toupdate.txt ISSN's file from FTP controller directory")
+        tools.get_to_update_file_from_ftp(
+            ftp_host=SETTINGS.ftp_host,
+            user=SETTINGS.ftp_user,
+            passwd=SETTINGS.ftp_passwd,
+        )
+        issns = tools.load_journals_list(journals_file="controller/toupdate.txt")
+    elif task == "add":
+        logger.debug("Loading keepinto.txt ISSN's file from FTP controller directory")
+        tools.get_keep_into_file_from_ftp(
+            ftp_host=SETTINGS.ftp_host,
+            user=SETTINGS.ftp_user,
+            passwd=SETTINGS.ftp_passwd,
+        )
+        issns = tools.load_journals_list(journals_file="controller/keepinto.txt")
+
+    collection_issns = _get_collection_issns(collection)
+    valid_issns = tools.CodeSet(issns or [], tools.ISSN_WIDTH) & tools.CodeSet(
+        [issn for issn in collection_issns if len(issn) == tools.ISSN_WIDTH],
+        tools.ISSN_WIDTH,
+    )
+    if not valid_issns:
+        logger.error("No valid issns to process")
+        exit()
+
+    # Setup a connection to SciELO Network Collection
+    logger.debug(
+        "Connecting to mongodb with DataHandler thru %s" % (SETTINGS.mongodb_host)
+    )
+    dh = tools.DataHandler(
+        SETTINGS.mongodb_host,
+        read_preference=SETTINGS.mongodb_read_preference,
+        read_pool_size=SETTINGS.mongodb_read_pool_size,
+        max_staleness_seconds=SETTINGS.mongodb_max_staleness_seconds,
+    )
+    collections = dh.load_collections_metadata()
+
+    # logger.debug("Remove previous inbound files")
+    # tools.remove_previous_unbound_files_from_ftp(ftp_host=SETTINGS.ftp_host,
+    #                              user=SETTINGS.ftp_user,
+    #                              passwd=SETTINGS.ftp_passwd)
+
+    if sync_sent and dry_run:
+        logger.warning("Dry run: not syncing the XML's status from WoS")
+    elif sync_sent:
+        logger.debug("Syncing XML's status according to WoS validated files")
+        tools.sync_sent_documents_from_ftp(
+            dh,
+            ftp_host=SETTINGS.ftp_host,
+            user=SETTINGS.ftp_user,
+            passwd=SETTINGS.ftp_passwd,
+            remove_origin=clean_garbage,
+            workers=workers,
+        )
+
+    # logger.debug("Creating file with a list of documents to be removed from WoS")
+    # tools.get_take_off_files_from_ftp(ftp_host=SETTINGS.ftp_host,
+    #                                   user=SETTINGS.ftp_user,
+    #                                   passwd=SETTINGS.ftp_passwd,
+    #                                   remove_origin=clean_garbage)
+
+    # ids_to_remove = dh.load_pids_list_to_be_removed()
+
+    # tools.send_take_off_files_to_ftp(ftp_host=SETTINGS.ftp_host,
+    #                                  user=SETTINGS.ftp_user,
+    #                                  passwd=SETTINGS.ftp_passwd,
+    #                                  remove_origin=clean_garbage)
+
+    if dry_run:
+        logger.info("Dry run: not defining the document types elegible to SCI")
+    else:
+        logger.debug("Defining document types elegible to send to SCI")
+        dh.set_elegible_document_types()
+
+    plan = plan_run(dh, collection, task, valid_issns, quarantine)
+    logger.info("Execution plan:\n{}".format(plan))
+    if plan_only:
+        print(plan)
+        return
+
+    exporter = Exporter(
+        dh,
+        collection,
+        task,
+        workers=workers,
+        processes=processes,
+        dry_run=dry_run,
+        max_articles=max_articles,
+        max_bytes=max_bytes,
+        quarantine=quarantine,
+        resend_unchanged=resend_unchanged,
+    )
+    now = datetime.now().isoformat()[0:10]
+    # the ISSNs paused by the previous run first
+    issns = [issn for issn in plan.issns if issn in exporter.paused] + [
+        issn for issn in plan.issns if issn not in exporter.paused
+    ]
+
+    if daemon:
+        ExportDaemon(
+            exporter,
+            valid_issns,
+            max_documents=flush_documents,
+            max_wait=flush_seconds,
+        ).run(catch_up_issns=issns)
+        exporter.close()
+        return
+
+    # Loading XML files
+    with utils.profiling(
+        "reports/profile_{}_{}_{}".format(collection, task, now),
+        profile=profile == "run",
+        trace_memory=trace_memory == "run",
+    ):
+        for issn in issns:
+
+            # if issn in ids_to_remove:
+            #     logger.debug(
+            #         "Issn {0} is available in the takeoff and keepinto file. For now this ISSN was ignored, and will not be send to WoS until it is removed from the takeoff file.".format(
+            #             issn
+            #         )
+            #     )
+            #     continue
+
+            with utils.profiling(
+                "reports/profile_{}_{}_{}".format(collection, issn, now),
+                profile=profile == "issn",
+                trace_memory=trace_memory == "issn",
+            ):
+                exporter.wait_for_articlemeta()
+                exporter.export_issn(issn)
+        exporter.resume_paused()
+
+    exporter.close()
+
+    if dry_run:
+        print("Dry run of {} ({})".format(collection, task))
+        for throughput in exporter.throughputs:
+            print(throughput)
+    else:
+        ThroughputHistory(_throughput_history_filename(collection, task)).add(
+            exporter.throughputs
+        )
 
 
 def skip_because_of_processing_date(proc_date_ctrl, document):
@@ -367,17 +1379,174 @@ def main():
     parser.add_argument(
         "--logging_level",
         "-l",
-        default="DEBUG",
+        default="INFO",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="Logggin level",
     )
 
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of documents fetched and validated concurrently.",
+    )
+
+    parser.add_argument(
+        "--processes",
+        "-p",
+        type=int,
+        default=0,
+        help="Number of processes parsing and validating the XML against the "
+        "schema. With 0 the validation runs in the fetching threads.",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        "--validate-only",
+        dest="dry_run",
+        action="store_true",
+        default=False,
+        help="Query, fetch and validate the documents and report the "
+        "throughput, without packing, sending or marking them as sent.",
+    )
+
+    parser.add_argument(
+        "--plan",
+        dest="plan_only",
+        action="store_true",
+        default=False,
+        help="Print the number of documents of each ISSN to be processed and "
+        "the estimated time, without processing them.",
+    )
+
+    parser.add_argument(
+        "--max_articles",
+        type=int,
+        default=0,
+        help="Maximum number of articles of each XML file sent (0 for no limit).",
+    )
+
+    parser.add_argument(
+        "--max_bytes",
+        type=int,
+        default=0,
+        help="Maximum size in bytes of each XML file sent (0 for no limit).",
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="run",
+        default=None,
+        choices=["run", "issn"],
+        help="Profile the whole run or each ISSN with cProfile, writing "
+        "reports/profile_*.pstats. The run is then in a single thread and "
+        "process.",
+    )
+
+    parser.add_argument(
+        "--trace-memory",
+        "--trace_memory",
+        dest="trace_memory",
+        nargs="?",
+        const="run",
+        default=None,
+        choices=["run", "issn"],
+        help="Trace the memory allocations of the whole run or of each ISSN "
+        "with tracemalloc, writing the top allocations to "
+        "reports/profile_*.memory.txt. Python 2 needs the pytracemalloc "
+        "backport. The validation then runs in the fetching threads.",
+    )
+
+    parser.add_argument(
+        "--resend_unchanged",
+        action="store_true",
+        default=False,
+        help="update: send the documents whose XML did not change since they "
+        "were sent.",
+    )
+
+    parser.add_argument(
+        "--no_quarantine",
+        dest="quarantine",
+        action="store_false",
+        default=True,
+        help="Select again the documents quarantined because of invalid "
+        "payloads and do not quarantine new ones.",
+    )
+
+    parser.add_argument(
+        "--sync_sent",
+        action="store_true",
+        default=False,
+        help="Before exporting, mark as sent the documents listed in the "
+        "ProcessedRecordIds reports of WoS not applied yet.",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=False,
+        help="Keep running, exporting the articles as they change in MongoDB "
+        "(requires a replica set).",
+    )
+
+    parser.add_argument(
+        "--flush_documents",
+        type=int,
+        default=500,
+        help="Daemon: export an ISSN when this number of documents is buffered.",
+    )
+
+    parser.add_argument(
+        "--flush_seconds",
+        type=int,
+        default=600,
+        help="Daemon: export an ISSN this number of seconds after its first "
+        "buffered document.",
+    )
+
+    parser.add_argument(
+        "--metrics_file",
+        default=None,
+        help="File where the metrics of the run are written in the Prometheus "
+        "text format (e.g. for the node_exporter textfile collector).",
+    )
+
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Local port where the metrics of the run are served at /metrics.",
+    )
+
     args = parser.parse_args()
 
     _config_logging(args.logging_level, args.logging_file)
     logging.debug("Export SciELOCI %s" % VERSION)
+    if args.metrics_file:
+        metrics.REGISTRY.start_textfile_writer(args.metrics_file)
+    if args.metrics_port:
+        metrics.REGISTRY.serve(args.metrics_port)
     run(
         collection=args.collection,
         task=str(args.task),
         clean_garbage=bool(args.clean_garbage),
+        workers=max(args.workers, 1),
+        processes=max(args.processes, 0),
+        dry_run=bool(args.dry_run),
+        max_articles=max(args.max_articles, 0),
+        max_bytes=max(args.max_bytes, 0),
+        plan_only=bool(args.plan_only),
+        profile=args.profile,
+        trace_memory=args.trace_memory,
+        daemon=bool(args.daemon),
+        flush_documents=max(args.flush_documents, 1),
+        flush_seconds=max(args.flush_seconds, 1),
+        sync_sent=bool(args.sync_sent),
+        quarantine=bool(args.quarantine),
+        resend_unchanged=bool(args.resend_unchanged),
     )
+    if args.metrics_file:
+        metrics.REGISTRY.write_textfile(args.metrics_file)
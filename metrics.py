@@ -0,0 +1,258 @@
+# coding: utf-8
+"""
+Counters, gauges and histograms of an export run, rendered in the Prometheus
+text format to a textfile (for node_exporter's textfile collector) or served
+by a small local HTTP endpoint.
+"""
+
+import os
+import time
+import logging
+import threading
+import contextlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.labelnames, key), value)]
+
+
+class Counter(_Metric):
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_only(self, value, **labels):
+        """
+        Sets ``value`` for ``labels`` and removes the other label values,
+        e.g. to publish the ISSN being processed.
+        """
+        with self._lock:
+            self._values = {self._key(labels): value}
+
+
+class Histogram(_Metric):
+
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            counts = [
+                bucket_count + (1 if value <= bucket else 0)
+                for bucket_count, bucket in zip(counts, self.buckets)
+            ]
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        for bucket, bucket_count in zip(self.buckets, counts):
+            lines.append(
+                "%s_bucket%s %s"
+                % (
+                    self.name,
+                    _format_labels(self.labelnames + ("le",), key + (bucket,)),
+                    bucket_count,
+                )
+            )
+        labels = _format_labels(self.labelnames, key)
+        lines.append(
+            "%s_bucket%s %s"
+            % (
+                self.name,
+                _format_labels(self.labelnames + ("le",), key + ("+Inf",)),
+                count,
+            )
+        )
+        lines.append("%s_sum%s %s" % (self.name, labels, total))
+        lines.append("%s_count%s %s" % (self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, filename):
+        """
+        Writes the metrics to ``filename`` atomically, as expected by the
+        textfile collector.
+        """
+        tmp = "%s.%s.tmp" % (filename, os.getpid())
+        with open(tmp, "w") as fp:
+            fp.write(self.render())
+        os.rename(tmp, filename)
+
+    def start_textfile_writer(self, filename, interval=15):
+        """
+        Rewrites ``filename`` every ``interval`` seconds in a daemon thread.
+        """
+
+        def write():
+            while True:
+                try:
+                    self.write_textfile(filename)
+                except (IOError, OSError):
+                    logger.exception("Unable to write metrics to %s", filename)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=write, name="metrics-textfile")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serves the metrics at ``http://host:port/metrics`` in a daemon thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+REGISTRY = Registry()
+
+DOCUMENTS_FETCHED = REGISTRY.counter(
+    "exportsci_documents_fetched_total", "Documents fetched from ArticleMeta."
+)
+FETCHED_BYTES = REGISTRY.counter(
+    "exportsci_fetched_bytes_total", "Bytes fetched from ArticleMeta."
+)
+DOCUMENTS_VALIDATED = REGISTRY.counter(
+    "exportsci_documents_validated_total",
+    "Documents valid according to the Clarivate schema.",
+    ["issn"],
+)
+DOCUMENTS_REJECTED = REGISTRY.counter(
+    "exportsci_documents_rejected_total",
+    "Documents skipped, invalid or which could not be validated.",
+    ["issn"],
+)
+DOCUMENTS_UNCHANGED = REGISTRY.counter(
+    "exportsci_documents_unchanged_total",
+    "Valid documents not sent again because they did not change.",
+    ["issn"],
+)
+ZIPPED_BYTES = REGISTRY.counter("exportsci_zipped_bytes_total", "Bytes of zip files.")
+FTP_UPLOAD_SECONDS = REGISTRY.histogram(
+    "exportsci_ftp_upload_seconds", "Duration of the FTP uploads."
+)
+MONGODB_QUERY_SECONDS = REGISTRY.histogram(
+    "exportsci_mongodb_query_seconds",
+    "Duration of the MongoDB queries.",
+    ["operation"],
+)
+ARTICLEMETA_CONCURRENCY = REGISTRY.gauge(
+    "exportsci_articlemeta_concurrency",
+    "Concurrent ArticleMeta requests allowed by the adaptive throttle.",
+)
+ARTICLEMETA_CIRCUIT_OPEN = REGISTRY.gauge(
+    "exportsci_articlemeta_circuit_open",
+    "1 while the ArticleMeta requests are suspended.",
+)
+CURRENT_ISSN = REGISTRY.gauge(
+    "exportsci_current_issn", "ISSN being processed.", ["collection", "issn"]
+)
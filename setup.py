@@ -14,7 +14,7 @@ with open(os.path.join(here, 'VERSION')) as f:
 
 requires = [
     'requests>=2.18.1',
-    'pymongo>=3.4.0',
+    'pymongo>=3.8.0',
     'lxml>=3.8.0'
 ]
 
@@ -44,5 +44,6 @@ setup(
     entry_points="""\
     [console_scripts]
     exportsci=exportsci:main
+    exportsci_benchmark_zip=tools:benchmark_zip_main
     """,
 )
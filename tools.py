@@ -2,18 +2,37 @@
 import re
 from datetime import datetime
 import os
+import hashlib
+import json
 import shutil
+import fnmatch
+import tempfile
+import time
 import zipfile
+import zlib
+import argparse
 from ftplib import FTP, error_perm, all_errors
 import logging
 import contextlib
+import atexit
+import bisect
+import codecs
+import collections
+import heapq
+import itertools
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 
 import requests
-from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from pymongo.errors import CursorNotFound, PyMongoError
 from lxml import etree
-from StringIO import StringIO
 
-from utils import earlier_datetime
+import metrics
+from utils import earlier_datetime, lazy_property
 
 
 # SciELO article types stored in field v71 that are allowed to be sent to WoS
@@ -43,6 +62,47 @@ wos_article_types = [
 
 XML_ERRORS_ROOT_PATH = "xml_errors"
 
+ISSN_WIDTH = 9
+PID_WIDTH = 23
+
+FTP_BLOCKSIZE = 8192
+
+# Options of the XMLParsers: "payload" parses the xmlwos as it is sent and
+# "pretty" parses its pretty printed version, which is only validated
+PARSER_OPTIONS = {
+    "payload": {"resolve_entities": False, "huge_tree": True, "encoding": "utf-8"},
+    "pretty": {
+        "remove_blank_text": True,
+        "resolve_entities": False,
+        "huge_tree": True,
+        "encoding": "utf-8",
+    },
+}
+
+_parsers = threading.local()
+
+
+def xml_parser(name="payload"):
+    """
+    Returns the XMLParser ``name`` of the current thread. lxml parsers can
+    not be shared among threads, so each thread (and process) creates and
+    then reuses its own.
+    """
+    parsers = _parsers.__dict__
+    if name not in parsers:
+        parsers[name] = etree.XMLParser(**PARSER_OPTIONS[name])
+    return parsers[name]
+
+
+def parse_xml(text, parser="payload"):
+    """
+    Parses ``text`` as utf-8 bytes, without a file-like wrapper.
+    Returns the ElementTree.
+    """
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return etree.fromstring(text, xml_parser(parser)).getroottree()
+
 
 def remove_contrib_id(text):
     if "</contrib-id>" not in text:
@@ -51,7 +111,7 @@ def remove_contrib_id(text):
     p = text.find("<article")
     pref = text[:p]
     xml = text[p:]
-    xmltree = etree.fromstring(xml)
+    xmltree = parse_xml(xml).getroot()
     for contrib_id in xmltree.findall(".//contrib-id"):
         parent = contrib_id.getparent()
         parent.remove(contrib_id)
@@ -59,19 +119,196 @@ def remove_contrib_id(text):
 
 
 def delete_file_or_folder(path):
-    if os.path.isdir(path):
-        for item in os.listdir(path):
-            delete_file_or_folder(path + "/" + item)
-        try:
+    try:
+        if os.path.isdir(path):
             shutil.rmtree(path)
-        except:
-            logging.info("Unable to delete: %s" % path)
+        elif os.path.isfile(path):
+            os.unlink(path)
+    except OSError:
+        logging.info("Unable to delete: %s" % path)
+
+
+def remove_files(path, pattern, recursive=True):
+    """
+    Removes the files of ``path``, and of its subdirectories if
+    ``recursive``, whose name matches ``pattern``.
+    Returns the number of files removed.
+    """
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in fnmatch.filter(filenames, pattern):
+            try:
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+            except OSError:
+                logging.info("Unable to delete: %s" % os.path.join(dirpath, name))
+        if not recursive:
+            break
+    return removed
+
+
+class ArtifactStore(object):
+    """
+    Records the files produced by a run, one JSON line per file, in the run
+    manifest ``<root>/run_<run_id>.jsonl``, stores the uploaded zips and
+    enforces the retention of the output directories.
+
+    With ``link_duplicates``, a zip identical to one already stored becomes a
+    hard link to it.
 
-    elif os.path.isfile(path):
+    A long-lived process starts a new run with ``start_run``, so that the
+    files of the previous ones can be collected.
+    """
+
+    def __init__(
+        self, root="artifacts", run_id=None, zips_path="zips", link_duplicates=False
+    ):
+        self.root = root
+        self.zips_index_filename = os.path.join(root, "zips_index.json")
+        self.zips_path = zips_path
+        self.link_duplicates = link_duplicates
+        self._lock = threading.Lock()
+        self.start_run(run_id)
+
+    def start_run(self, run_id=None):
+        """
+        Records the following files in a new run manifest. The files recorded
+        by the previous run are no longer kept from ``collect``.
+        """
+        with self._lock:
+            self.run_id = run_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.manifest_filename = os.path.join(
+                self.root, "run_%s.jsonl" % self.run_id
+            )
+            # files which are not collected
+            self.paths = set(
+                os.path.abspath(filename)
+                for filename in (self.manifest_filename, self.zips_index_filename)
+            )
+
+    @lazy_property
+    def zips_index(self):
+        """
+        Path of the stored zips by checksum.
+        """
         try:
-            os.unlink(path)
-        except:
-            logging.info("Unable to delete: %s" % path)
+            with open(self.zips_index_filename, "r") as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def _makedirs(self, path):
+        if path and not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def add(self, kind, path, **extra):
+        """
+        Records the file ``path`` of ``kind`` (xml, zip, pids, ...) in the run
+        manifest. Returns ``path``.
+        """
+        record = {"kind": kind, "path": path, "recorded_at": datetime.now().isoformat()}
+        try:
+            record["size"] = os.path.getsize(path)
+        except OSError:
+            pass
+        record.update(extra)
+        with self._lock:
+            self._makedirs(self.root)
+            with open(self.manifest_filename, "a") as fp:
+                fp.write(json.dumps(record, sort_keys=True) + "\n")
+            self.paths.add(os.path.abspath(path))
+        return path
+
+    def store_zip(self, zip_filename):
+        """
+        Moves the uploaded ``zip_filename`` to the zips directory and records
+        it. Returns its new path.
+        """
+        self._makedirs(self.zips_path)
+        target = os.path.join(self.zips_path, os.path.basename(zip_filename))
+        checksum = file_checksum(zip_filename)
+        duplicate = self.zips_index.get(checksum)
+        if (
+            self.link_duplicates
+            and duplicate
+            and duplicate != target
+            and os.path.isfile(duplicate)
+        ):
+            if os.path.exists(target):
+                os.remove(target)
+            os.link(duplicate, target)
+            os.remove(zip_filename)
+            logging.info("%s is a link to the identical %s", target, duplicate)
+        else:
+            shutil.move(zip_filename, target)
+            with self._lock:
+                self.zips_index[checksum] = target
+                self._makedirs(self.root)
+                with open(self.zips_index_filename, "w") as fp:
+                    json.dump(self.zips_index, fp, indent=2, sort_keys=True)
+        return self.add("zip", target, md5=checksum)
+
+    def collect(self, paths, max_age_days=0, max_bytes=0):
+        """
+        Walks ``paths`` once and removes the files older than
+        ``max_age_days``, then the oldest ones until the remaining add up to
+        ``max_bytes``, and the directories left empty. The files recorded by
+        this run are kept and do not count towards ``max_bytes``. Zero
+        disables a limit.
+        Returns the number of files and of bytes removed.
+        """
+        files = []
+        directories = []
+        for path in paths:
+            # bottom-up, so that the empty directories are removed in order
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                for name in filenames:
+                    filename = os.path.join(dirpath, name)
+                    if os.path.abspath(filename) in self.paths:
+                        continue
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, filename))
+                if dirpath != path:
+                    directories.append(dirpath)
+
+        files.sort()
+        total = sum(size for mtime, size, filename in files)
+        expired_before = time.time() - max_age_days * 86400
+        removed = removed_bytes = 0
+        for mtime, size, filename in files:
+            expired = max_age_days and mtime < expired_before
+            exceeding = max_bytes and total > max_bytes
+            if not expired and not exceeding:
+                # the following files are newer
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+
+        for dirpath in directories:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # not empty
+                pass
+        logging.info(
+            "Retention: %i files (%i bytes) removed, %i bytes kept",
+            removed,
+            removed_bytes,
+            total,
+        )
+        return removed, removed_bytes
 
 
 class FTPService(object):
@@ -100,8 +337,10 @@ class FTPService(object):
     @contextlib.contextmanager
     def session_context(self, timeout=60):
         self.connect(timeout)
-        yield
-        self.close()
+        try:
+            yield
+        finally:
+            self.close()
 
     def mkdirs(self, dirs, timeout=60):
         with self.session_context(timeout):
@@ -113,17 +352,125 @@ class FTPService(object):
                     logging.info("FTP: MKD (%s)" % (dirs,), exc_info=True)
                 self.ftp.cwd(folder)
 
-    def send_file(self, local_filename, remote_filename, timeout=60):
-        with self.session_context(timeout):
-            f = open(local_filename, "rb")
-            try:
-                self.ftp.storbinary("STOR {}".format(remote_filename), f)
-            except all_errors:
-                logging.info(
-                    "FTP: Unable to send %s to %s" % (local_filename, remote_filename),
-                    exc_info=True,
-                )
-            f.close()
+    def remote_size(self, remote_filename):
+        """
+        Returns the size of ``remote_filename`` or ``None`` if it does not
+        exist or the server does not implement SIZE.
+        """
+        try:
+            return self.ftp.size(remote_filename)
+        except all_errors:
+            return None
+
+    def upload(
+        self, local_filename, remote_filename, blocksize=FTP_BLOCKSIZE, manifest=None
+    ):
+        """
+        Sends ``local_filename`` in the current session and verifies its size
+        with SIZE. Raises ``IOError`` if the sizes differ.
+
+        Given an ``UploadManifest`` which registers ``local_filename`` with
+        the same checksum, a partial remote file is resumed from its size
+        (REST) and a complete one is not sent again.
+        """
+        size = os.path.getsize(local_filename)
+        checksum = file_checksum(local_filename)
+        self.ftp.voidcmd("TYPE I")
+        remote_size = self.remote_size(remote_filename)
+
+        offset = 0
+        if manifest is not None:
+            record = manifest.get(remote_filename)
+            if record.get("md5") == checksum and remote_size:
+                if record.get("sent") and remote_size == size:
+                    logging.info("FTP: %s already sent" % remote_filename)
+                    return
+                if remote_size < size:
+                    offset = remote_size
+            manifest.update(
+                remote_filename,
+                local=local_filename,
+                size=size,
+                md5=checksum,
+                sent=False,
+            )
+
+        if offset:
+            logging.info("FTP: resuming %s from %i" % (remote_filename, offset))
+        with open(local_filename, "rb") as f, metrics.FTP_UPLOAD_SECONDS.time():
+            f.seek(offset)
+            self.ftp.storbinary(
+                "STOR {}".format(remote_filename), f, blocksize, rest=offset or None
+            )
+
+        remote_size = self.remote_size(remote_filename)
+        if remote_size is None:
+            logging.info("FTP: unable to verify the size of %s" % remote_filename)
+        elif remote_size != size:
+            raise IOError(
+                "FTP: %s has %i bytes, expected %i"
+                % (remote_filename, remote_size, size)
+            )
+        if manifest is not None:
+            manifest.update(remote_filename, sent=True)
+
+    def send_file(
+        self,
+        local_filename,
+        remote_filename,
+        timeout=60,
+        blocksize=FTP_BLOCKSIZE,
+        manifest=None,
+    ):
+        """
+        Returns whether ``local_filename`` was sent.
+        """
+        try:
+            with self.session_context(timeout):
+                self.upload(local_filename, remote_filename, blocksize, manifest)
+        except all_errors:
+            logging.info(
+                "FTP: Unable to send %s to %s" % (local_filename, remote_filename),
+                exc_info=True,
+            )
+            return False
+        return True
+
+
+def file_checksum(filename, blocksize=1 << 20):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class UploadManifest(object):
+    """
+    Size, checksum and state of the files uploaded in a run, stored as JSON
+    in ``filename``, so that retries only send what is missing.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._items = {}
+        if os.path.isfile(filename):
+            with open(filename, "r") as fp:
+                self._items = json.load(fp)
+
+    def get(self, remote_filename):
+        return self._items.get(remote_filename, {})
+
+    def update(self, remote_filename, **kwargs):
+        self._items.setdefault(remote_filename, {}).update(kwargs)
+        self.save()
+
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.filename, "w") as fp:
+            json.dump(self._items, fp, indent=2, sort_keys=True)
 
 
 class CollectionReports(object):
@@ -199,43 +546,258 @@ def send_collections_reports(
             reports.ftp(ftp_service, remote_path, delete=True)
 
 
-def update_zipfile(zip_filename, files, src_path, mode="a", delete=False):
+ZIP_LEVEL = 6
+ZIP_BLOCKSIZE = 1 << 20
+ZIP_WORKERS = multiprocessing.cpu_count()
+
+
+def _deflate_block(item):
+    block, level, last = item
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def _read_blocks(fp, blocksize):
+    """
+    Yields ``(block, last)`` for the blocks of ``fp``.
+    """
+    block = fp.read(blocksize)
+    while True:
+        following = fp.read(blocksize)
+        yield block, not following
+        if not following:
+            return
+        block = following
+
+
+class ZipWriter(object):
+    """
+    Adds members to zip files deflating them in blocks of ``blocksize`` bytes
+    in ``workers`` threads (zlib releases the GIL), as pigz does.
+    Each block is deflated on its own and flushed to a byte boundary, so the
+    blocks make a single standard deflate stream and the zip can be read by
+    any zip tool.
+    """
+
+    def __init__(self, level=ZIP_LEVEL, workers=ZIP_WORKERS, blocksize=ZIP_BLOCKSIZE):
+        self.level = level
+        self.workers = workers
+        self.blocksize = blocksize
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _deflate(self, fp, size):
+        """
+        Yields ``(block, deflated block)`` for the blocks of ``fp``.
+        """
+        blocks = (
+            (block, self.level, last)
+            for block, last in _read_blocks(fp, self.blocksize)
+        )
+        if self.workers <= 1 or size <= self.blocksize:
+            for item in blocks:
+                yield item[0], _deflate_block(item)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        while True:
+            # a bounded number of blocks in memory
+            batch = list(itertools.islice(blocks, self.workers * 2))
+            if not batch:
+                return
+            for item, data in zip(batch, self._pool.imap(_deflate_block, batch)):
+                yield item[0], data
+
+    def write(self, zipf, filename, arcname=None):
+        """
+        Adds ``filename`` to the ZipFile ``zipf`` as ``arcname``.
+        """
+        st = os.stat(filename)
+        zinfo = zipfile.ZipInfo(
+            arcname or os.path.basename(filename), time.localtime(st.st_mtime)[:6]
+        )
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = st.st_size
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        crc = 0
+        file_size = 0
+        with open(filename, "rb") as fp:
+            for block, data in self._deflate(fp, st.st_size):
+                crc = zlib.crc32(block, crc)
+                file_size += len(block)
+                zinfo.compress_size += len(data)
+                zipf.fp.write(data)
+        zinfo.CRC = crc & 0xFFFFFFFF
+        zinfo.file_size = file_size
+
+        # rewrites the header with the sizes and CRC
+        position = zipf.fp.tell()
+        zipf.fp.seek(zinfo.header_offset)
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        zipf.fp.seek(position)
+        zipf.start_dir = position
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def update_zipfile(
+    zip_filename,
+    files,
+    src_path,
+    mode="a",
+    delete=False,
+    level=ZIP_LEVEL,
+    workers=ZIP_WORKERS,
+):
     with zipfile.ZipFile(
         zip_filename, mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True
-    ) as zipf:
+    ) as zipf, ZipWriter(level, workers) as writer:
         for f in files:
             src = os.path.join(src_path, f)
-            zipf.write(src, arcname=f)
+            writer.write(zipf, src, arcname=f)
             if delete is True:
                 delete_file_or_folder(src)
     logging.info("Files zipped into: %s" % zip_filename)
 
 
+def benchmark_zip(filename, levels=(1, 6, 9), workers=(1, ZIP_WORKERS), repeat=3):
+    """
+    Zips ``filename`` with ``zipfile`` and with ZipWriter for each one of
+    ``levels`` and ``workers``, checking the zips with ``testzip``.
+    Returns ``(method, level, workers, seconds, zip size)`` rows, with the best
+    time of ``repeat`` runs.
+    """
+
+    def zipfile_write(zipf):
+        zipf.write(filename, os.path.basename(filename))
+
+    def zipwriter_write(level, workers):
+        def write(zipf):
+            with ZipWriter(level, workers) as writer:
+                writer.write(zipf, filename)
+
+        return write
+
+    candidates = [("zipfile", 6, 1, zipfile_write)]
+    for level in levels:
+        for n in sorted(set(workers)):
+            candidates.append(("ZipWriter", level, n, zipwriter_write(level, n)))
+
+    rows = []
+    fd, target = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        for method, level, n, write in candidates:
+            seconds = []
+            for i in range(repeat):
+                started = time.time()
+                with zipfile.ZipFile(
+                    target, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+                ) as zipf:
+                    write(zipf)
+                seconds.append(time.time() - started)
+            with zipfile.ZipFile(target) as zipf:
+                if zipf.testzip() is not None:
+                    raise zipfile.BadZipfile("%s produced a bad zip" % method)
+            rows.append((method, level, n, min(seconds), os.path.getsize(target)))
+    finally:
+        os.remove(target)
+    return rows
+
+
+def benchmark_zip_main():
+    parser = argparse.ArgumentParser(
+        description="Compares the zipfile and ZipWriter compression of a file"
+    )
+    parser.add_argument("filename", help="File to be zipped, e.g. a bundle")
+    parser.add_argument("--levels", default="1,6,9", help="Compression levels")
+    parser.add_argument(
+        "--workers", default="1,%i" % ZIP_WORKERS, help="Numbers of threads"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = benchmark_zip(
+        args.filename,
+        levels=[int(level) for level in args.levels.split(",")],
+        workers=[int(n) for n in args.workers.split(",")],
+        repeat=max(args.repeat, 1),
+    )
+    size = os.path.getsize(args.filename)
+    print("method     level workers  seconds    MB/s      bytes  ratio")
+    for method, level, n, seconds, zipped in rows:
+        print(
+            "%-10s %5i %7i %8.3f %7.1f %10i %6.3f"
+            % (
+                method,
+                level,
+                n,
+                seconds,
+                size / float(1 << 20) / max(seconds, 1e-6),
+                zipped,
+                zipped / float(size or 1),
+            )
+        )
+
+
 def write_file(filename, content, mode="w"):
     content = content.encode("utf-8")
     with open(filename, mode) as f:
         try:
             f.write(content)
         except (IOError, ValueError):
-            logging.error("Error writing file: %s" % filename, exc_info=True)
-        except Exception as e:
-            logging.exception("tools.write_file(): %s" % filename, e)
+            logging.error("Error writing file: %s", filename, exc_info=True)
+        except Exception:
+            logging.exception("tools.write_file(): %s", filename)
+
+
+# error report files opened by write_log, kept open until the process exits
+_error_reports = {}
+
+
+@atexit.register
+def _close_error_reports():
+    for error_report in _error_reports.values():
+        error_report.close()
+    _error_reports.clear()
 
 
 def write_log(msg):
     now = datetime.now().isoformat()[0:10]
     issn = msg.split(":")[1][1:10]
-    if not os.path.isdir("reports"):
-        os.makedirs("reports")
     filename = "reports/{0}_{1}_errors.txt".format(issn, now)
-    error_report = open(filename, "a")
+    error_report = _error_reports.get(filename)
+    if error_report is None:
+        if not os.path.isdir("reports"):
+            os.makedirs("reports")
+        error_report = _error_reports[filename] = open(filename, "a")
     msg = "%s\r\n" % msg
     try:
         error_report.write(msg.encode("utf-8"))
-    except Exception as e:
-        logging.exception("tools.write_log(%s): " % filename, e)
-
-    error_report.close()
+    except Exception:
+        logging.exception("tools.write_log(%s): ", filename)
 
 
 def ftp_connect(ftp_host="localhost", user="anonymous", passwd="anonymous"):
@@ -246,20 +808,36 @@ def ftp_connect(ftp_host="localhost", user="anonymous", passwd="anonymous"):
     return ftp
 
 
-def send_to_ftp(file_name, ftp_host="localhost", user="anonymous", passwd="anonymous"):
-
-    now = datetime.now().isoformat()[0:10]
-
-    target = "scielo_{0}.zip".format(now)
-
-    ftp = ftp_connect(ftp_host=ftp_host, user=user, passwd=passwd)
-    f = open("{0}".format(file_name), "rb")
-    ftp.storbinary("STOR inbound/{0}".format(file_name), f)
-    f.close()
-    ftp.quit()
-    logging.debug("file sent to ftp: %s" % target)
+def send_to_ftp(
+    file_name,
+    ftp_host="localhost",
+    user="anonymous",
+    passwd="anonymous",
+    send_reports=True,
+    blocksize=FTP_BLOCKSIZE,
+    manifest=None,
+    retries=0,
+):
+    """
+    Sends ``file_name`` to the inbound directory, resuming the upload up to
+    ``retries`` times. Raises the last error if it was not sent.
+    """
+    ftp_service = FTPService(ftp_host, user=user, passwd=passwd)
+    remote_filename = "inbound/{0}".format(file_name)
+    for attempt in range(retries + 1):
+        try:
+            with ftp_service.session_context():
+                ftp_service.upload(file_name, remote_filename, blocksize, manifest)
+        except all_errors:
+            if attempt == retries:
+                raise
+            logging.info("FTP: retrying %s" % file_name, exc_info=True)
+        else:
+            break
+    logging.debug("file sent to ftp: %s" % remote_filename)
 
-    send_collections_reports(ftp_host, user, passwd)
+    if send_reports:
+        send_collections_reports(ftp_host, user, passwd)
 
 
 def send_take_off_files_to_ftp(
@@ -319,6 +897,130 @@ def get_sync_file_from_ftp(
             ftp.delete(report_file)
 
 
+class _PidLines(object):
+    """
+    Splits the data received by RETR in lines as it arrives and hands the
+    PIDs to ``handle`` in lists of ``chunk_size``.
+    """
+
+    def __init__(self, handle, chunk_size=1000):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.total = 0
+        self._rest = b""
+        self._pids = []
+
+    def __call__(self, data):
+        lines = (self._rest + data).split(b"\n")
+        self._rest = lines.pop()
+        for line in lines:
+            self._add(line)
+
+    def _add(self, line):
+        pid = line.strip().decode("utf-8")
+        if pid:
+            self._pids.append(pid)
+            if len(self._pids) >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self._pids:
+            self.handle(self._pids)
+            self.total += len(self._pids)
+            self._pids = []
+
+    def close(self):
+        self._add(self._rest)
+        self._rest = b""
+        self.flush()
+
+
+class AppliedReports(object):
+    """
+    Names of the report files already applied, one per line in ``filename``.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._names = set()
+        if os.path.isfile(filename):
+            with open(filename, "r") as fp:
+                self._names = set(line.strip() for line in fp if line.strip())
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def add(self, name):
+        with self._lock:
+            self._names.add(name)
+            with open(self.filename, "a") as fp:
+                fp.write("%s\n" % name)
+
+
+def sync_sent_documents_from_ftp(
+    dh,
+    ftp_host="localhost",
+    user="anonymous",
+    passwd="anonymous",
+    remove_origin=False,
+    workers=4,
+    chunk_size=1000,
+    applied_filename="controller/applied_sync_reports.txt",
+):
+    """
+    Marks as sent the PIDs of the SCIELO_ProcessedRecordIds* reports.
+
+    The reports are downloaded by ``workers`` parallel connections and their
+    PIDs are marked ``chunk_size`` at a time while the data arrives, without
+    writing them to disk. The reports applied are recorded in
+    ``applied_filename`` and skipped by the next runs.
+    """
+    applied = AppliedReports(applied_filename)
+    ftp = ftp_connect(ftp_host=ftp_host, user=user, passwd=passwd)
+    ftp.cwd("reports")
+    report_files = [
+        report_file
+        for report_file in ftp.nlst("SCIELO_ProcessedRecordIds*")
+        if report_file not in applied
+    ]
+    ftp.quit()
+
+    def apply(report_file):
+        pid_lines = _PidLines(dh.mark_documents_as_sent_to_wos, chunk_size)
+        try:
+            ftp = ftp_connect(ftp_host=ftp_host, user=user, passwd=passwd)
+            try:
+                ftp.cwd("reports")
+                ftp.retrbinary("RETR %s" % report_file, pid_lines)
+                pid_lines.close()
+                applied.add(report_file)
+                if remove_origin:
+                    ftp.delete(report_file)
+                    logging.debug(
+                        "Syncronization file removed from ftp: %s", report_file
+                    )
+            finally:
+                ftp.quit()
+        except all_errors + (PyMongoError,):
+            # not recorded as applied, so the next run applies it again
+            logging.exception("Unable to apply the report %s", report_file)
+            return report_file, None
+        return report_file, pid_lines.total
+
+    if not report_files:
+        return []
+    pool = ThreadPool(min(workers, len(report_files)))
+    try:
+        results = pool.map(apply, report_files)
+    finally:
+        pool.close()
+        pool.join()
+    for report_file, total in results:
+        logging.info("Synchronization %s: %s PIDs", report_file, total)
+    return results
+
+
 def get_to_update_file_from_ftp(
     ftp_host="localhost", user="anonymous", passwd="anonymous", remove_origin=False
 ):
@@ -388,7 +1090,14 @@ def get_take_off_files_from_ftp(
     f.close()
 
 
-def packing_zip(xml_file=None, files=None, xml_folder_path=None, zip_filename=None):
+def packing_zip(
+    xml_file=None,
+    files=None,
+    xml_folder_path=None,
+    zip_filename=None,
+    level=ZIP_LEVEL,
+    workers=ZIP_WORKERS,
+):
     now = datetime.now().isoformat()[0:10]
 
     target = zip_filename or "scielo_{0}.zip".format(now)
@@ -397,18 +1106,93 @@ def packing_zip(xml_file=None, files=None, xml_folder_path=None, zip_filename=No
 
     with zipfile.ZipFile(
         target, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
-    ) as zipf:
+    ) as zipf, ZipWriter(level, workers) as writer:
         if xml_file:
-            zipf.write(xml_file, arcname=os.path.basename(xml_file))
+            writer.write(zipf, xml_file, arcname=os.path.basename(xml_file))
         elif files and xml_folder_path:
             for xml_file in files:
-                zipf.write("{}/{}".format(xml_folder_path, xml_file), arcname=xml_file)
+                writer.write(
+                    zipf, "{}/{}".format(xml_folder_path, xml_file), arcname=xml_file
+                )
 
     logging.debug("Files zipped into: %s" % target)
+    metrics.ZIPPED_BYTES.inc(os.path.getsize(target))
 
     return target
 
 
+def bundle_root():
+    """
+    Returns the empty ``<articles>`` element of the bundles sent to WoS.
+    """
+    nsmap = {
+        "xml": "http://www.w3.org/XML/1998/namespace",
+        "xlink": "http://www.w3.org/1999/xlink",
+    }
+    root = etree.Element("articles", nsmap=nsmap)
+    root.set("dtd-version", "1.12")
+    root.set(
+        "{http://www.w3.org/2001/XMLSchema-instance}noNamespaceSchemaLocation",
+        "Clarivate_publishing_1.12.xsd",
+    )
+    return root
+
+
+def bundle_header_and_footer():
+    """
+    Returns the serialized start and end tags of ``bundle_root()``.
+    """
+    root = bundle_root()
+    root.text = ""
+    text = etree.tostring(root, encoding="utf-8", method="xml")
+    footer = b"</articles>"
+    return text[: -len(footer)], footer
+
+
+def write_bundle(xml_file_name, fragments):
+    """
+    Writes the bundle ``xml_file_name`` concatenating the serialized
+    ``<article>`` ``fragments`` (see ``article_fragment``) under the
+    ``<articles>`` element, instead of building and serializing a tree.
+    """
+    header, footer = bundle_header_and_footer()
+    with open(xml_file_name, "wb") as fp:
+        fp.write(header)
+        for fragment in fragments:
+            fp.write(fragment)
+        fp.write(footer)
+
+
+def bundle_chunks(fragments, pids, exports, max_articles=0, max_bytes=0):
+    """
+    Splits the ``fragments`` of a bundle, and their ``pids`` and ``exports``
+    (``(_id, checksum)`` of each fragment), in chunks of at most
+    ``max_articles`` articles and ``max_bytes`` bytes (0 means no limit).
+    A fragment larger than ``max_bytes`` makes a chunk on its own.
+    Yields ``(fragments, pids, exports)``.
+    """
+    chunk_fragments = []
+    chunk_pids = []
+    chunk_exports = []
+    size = 0
+    for fragment, pid, export in zip(fragments, pids, exports):
+        if chunk_fragments and (
+            (max_articles and len(chunk_fragments) >= max_articles)
+            or (max_bytes and size + len(fragment) > max_bytes)
+        ):
+            yield chunk_fragments, chunk_pids, chunk_exports
+            chunk_fragments = []
+            chunk_pids = []
+            chunk_exports = []
+            size = 0
+        chunk_fragments.append(fragment)
+        chunk_pids.append(pid)
+        chunk_exports.append(export)
+        size += len(fragment)
+    if chunk_fragments:
+        yield chunk_fragments, chunk_pids, chunk_exports
+
+
 def load_journals_list(journals_file="journals.txt"):
     # ISSN REGEX
     prog = re.compile("^[0-9]{4}-[0-9]{3}[0-9X]$")
@@ -436,59 +1220,631 @@ def load_journals_list(journals_file="journals.txt"):
         return None
 
 
+def articlemeta_session(pool_size=10, max_retries=3, backoff_factor=0.5):
+    """
+    Returns a ``requests.Session`` which keeps up to ``pool_size`` connections
+    alive per host and retries failed idempotent requests.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.headers.update(
+        {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+XSD_FILENAME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "xsd/Clarivate_publishing.xsd")
+)
+
+
+# Elements required by the Clarivate schema, looked up in the payloads before
+# parsing them
+REQUIRED_ELEMENTS = ("articles", "article", "front", "journal-meta", "article-meta")
+_REQUIRED_ELEMENTS = [
+    (name, re.compile(r"<%s[\s/>]" % re.escape(name))) for name in REQUIRED_ELEMENTS
+]
+
+
+EMPTY_XML = "Empty XML"
+NOT_XML = "Not an XML document"
+HTML_PAGE = "ArticleMeta returned an HTML page instead of xmlwos"
+MISSING_ELEMENT = "Missing <%s> element"
+PARSER_FAILURE = "tools.XML._parse_xml(): Unknown error. "
+SCHEMA_NOT_LOADED = "XMLSchema is not loaded"
+
+# errors which do not come from parsing or validating the payload against the
+# schema, so they do not quarantine the document
+NOT_QUARANTINABLE = set(
+    [EMPTY_XML, NOT_XML, HTML_PAGE, PARSER_FAILURE, SCHEMA_NOT_LOADED]
+    + [MISSING_ELEMENT % name for name in REQUIRED_ELEMENTS]
+)
+
+
+def precheck_payload(textxml, structural=True):
+    """
+    Returns the reason to reject the xmlwos ``textxml`` without parsing it,
+    e.g. an empty body or an HTML error page, or None if it has to go through
+    the schema validation.
+    With ``structural``, also rejects payloads which lack the elements
+    required by the schema.
+    """
+    if textxml is None or not textxml.strip():
+        return EMPTY_XML
+    head = textxml[:512]
+    if isinstance(head, unicode):
+        head = head.lstrip(codecs.BOM_UTF8.decode("utf-8"))
+    elif head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8) :]
+    head = head.lstrip().lower()
+    if not head.startswith("<"):
+        return NOT_XML
+    if "<html" in head or "<!doctype html" in head:
+        return HTML_PAGE
+    if structural:
+        for name, pattern in _REQUIRED_ELEMENTS:
+            if pattern.search(textxml) is None:
+                return MISSING_ELEMENT % name
+
+
+def payload_checksum(textxml):
+    if isinstance(textxml, unicode):
+        textxml = textxml.encode("utf-8")
+    return hashlib.md5(textxml or b"").hexdigest()
+
+
+def errors_signature(errors):
+    """
+    Returns a checksum of the validation ``errors`` which does not depend on
+    the line and column numbers they refer to.
+    """
+    messages = sorted(set(re.sub(r"\d+", "#", error) for error in errors))
+    return hashlib.md5("\n".join(messages).encode("utf-8")).hexdigest()
+
+
+def quarantinable(errors):
+    """
+    Returns whether the validation ``errors`` come from parsing the payload
+    or validating it against the schema, and not from the prechecks, which
+    also reject the failures of ArticleMeta, or from the validator itself.
+    """
+    return bool(errors) and not NOT_QUARANTINABLE.intersection(errors)
+
+
+def article_fragment(tree):
+    """
+    Returns the ``<article>`` element of a validated xmlwos tree serialized
+    as utf-8 bytes.
+    """
+    return etree.tostring(tree.find("article"), encoding="utf-8")
+
+
+class CodeSet(object):
+    """
+    Sorted set of codes (ISSNs, PIDs) of at most ``width`` ASCII characters,
+    stored in a single string of fixed-width records instead of one string
+    object per code.
+
+    Membership is a binary search; intersection, difference and union merge
+    the sorted records.
+    """
+
+    def __init__(self, codes=(), width=PID_WIDTH, chunk_size=50000):
+        """
+        ``codes`` are sorted ``chunk_size`` at a time, so at most
+        ``chunk_size`` codes exist as Python strings at once; if there are
+        more, the sorted chunks are spilled to temporary files and merged.
+        """
+        self.width = width
+        chunks = self._sorted_chunks(codes, chunk_size)
+        first = next(chunks, [])
+        second = next(chunks, None)
+        if second is None:
+            self._data = self._join(first)
+            return
+
+        files = [self._spill(first), self._spill(second)]
+        del first, second
+        try:
+            for chunk in chunks:
+                files.append(self._spill(chunk))
+            self._data = self._join(
+                self._merge([self._file_records(fp) for fp in files])
+            )
+        finally:
+            for fp in files:
+                fp.close()
+
+    def _spill(self, chunk):
+        fp = tempfile.TemporaryFile("w+")
+        fp.write(self._join(chunk))
+        fp.seek(0)
+        return fp
+
+    def _file_records(self, fp):
+        return iter(lambda: fp.read(self.width), "")
+
+    @classmethod
+    def _from_records(cls, records, width):
+        code_set = cls(width=width)
+        code_set._data = cls._join(records)
+        return code_set
+
+    @classmethod
+    def from_file(cls, filename, width=PID_WIDTH):
+        """
+        Returns the set of the codes in the lines of ``filename``, ignoring
+        blank lines and lines longer than ``width``.
+        """
+        with open(filename, "r") as fp:
+            return cls((line for line in fp if 0 < len(line.strip()) <= width), width)
+
+    def record(self, code):
+        code = str(code).strip()
+        if len(code) > self.width:
+            raise ValueError("%s has more than %i characters" % (code, self.width))
+        return code.ljust(self.width)
+
+    def _sorted_chunks(self, codes, chunk_size):
+        codes = iter(codes)
+        while True:
+            chunk = sorted(
+                set(self.record(code) for code in itertools.islice(codes, chunk_size))
+            )
+            if not chunk:
+                break
+            yield chunk
+
+    @staticmethod
+    def _join(records, block_size=10000):
+        # "".join would make a list of all the records first
+        records = iter(records)
+        return "".join(iter(lambda: "".join(itertools.islice(records, block_size)), ""))
+
+    @staticmethod
+    def _merge(chunks):
+        previous = None
+        for record in heapq.merge(*chunks):
+            if record != previous:
+                yield record
+                previous = record
+
+    def __len__(self):
+        return len(self._data) // self.width
+
+    def __getitem__(self, i):
+        return self._data[i * self.width : (i + 1) * self.width]
+
+    def _records(self):
+        data = self._data
+        width = self.width
+        start = 0
+        while start < len(data):
+            yield data[start : start + width]
+            start += width
+
+    def __iter__(self):
+        for record in self._records():
+            yield record.rstrip()
+
+    def __contains__(self, code):
+        try:
+            record = self.record(code)
+        except ValueError:
+            return False
+        i = bisect.bisect_left(self, record)
+        return i < len(self) and self[i] == record
+
+    def _check(self, other):
+        if not isinstance(other, CodeSet):
+            other = CodeSet(other, self.width)
+        if other.width != self.width:
+            raise ValueError("CodeSets of different widths")
+        return other
+
+    def _compare(self, other):
+        """
+        Yields ``(record, in self, in other)`` merging both sets in order.
+        """
+        records, other_records = self._records(), other._records()
+        x, y = next(records, None), next(other_records, None)
+        while x is not None or y is not None:
+            if y is None or (x is not None and x < y):
+                yield x, True, False
+                x = next(records, None)
+            elif x is None or y < x:
+                yield y, False, True
+                y = next(other_records, None)
+            else:
+                yield x, True, True
+                x, y = next(records, None), next(other_records, None)
+
+    def intersection(self, other):
+        return self._from_records(
+            (
+                r
+                for r, mine, theirs in self._compare(self._check(other))
+                if mine and theirs
+            ),
+            self.width,
+        )
+
+    def difference(self, other):
+        return self._from_records(
+            (
+                r
+                for r, mine, theirs in self._compare(self._check(other))
+                if mine and not theirs
+            ),
+            self.width,
+        )
+
+    def union(self, other):
+        return self._from_records(
+            (r for r, mine, theirs in self._compare(self._check(other))), self.width
+        )
+
+    __and__ = intersection
+    __sub__ = difference
+    __or__ = union
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of sending a request while the upstream is unhealthy.
+    """
+
+
+class AdaptiveThrottle(object):
+    """
+    Controls the requests to an upstream AIMD-style: the number of
+    concurrent requests allowed grows by one after ``limit`` requests
+    succeed in time and halves on a failure or a response slower than
+    ``slow_seconds``. The timeout follows the average latency, between
+    ``min_timeout`` and ``timeout``.
+
+    If ``error_rate`` of the last ``window`` requests failed, the circuit
+    opens: for ``cooldown`` seconds ``acquire`` raises CircuitOpen, then a
+    single request is let through, while the others wait, and closes it if
+    it succeeds.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=10,
+        timeout=30,
+        min_timeout=5,
+        slow_seconds=10,
+        window=20,
+        error_rate=0.5,
+        cooldown=60,
+    ):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.timeout = timeout
+        self.min_timeout = min(min_timeout, timeout)
+        self.slow_seconds = slow_seconds
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.limit = self.max_concurrency
+        self.latency = None
+        self.opened_at = None
+        self._in_flight = 0
+        self._successes = 0
+        self._trial = False
+        self._outcomes = collections.deque(maxlen=window)
+        self._condition = threading.Condition()
+        metrics.ARTICLEMETA_CONCURRENCY.set(self.limit)
+
+    @property
+    def current_timeout(self):
+        if self.latency is None:
+            return self.timeout
+        return min(max(self.latency * 4, self.min_timeout), self.timeout)
+
+    def remaining_cooldown(self):
+        """
+        Seconds until the open circuit lets a request through, 0 if closed.
+        """
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.cooldown - time.time(), 0)
+
+    def wait(self):
+        """
+        Waits until the open circuit lets a request through.
+        """
+        remaining = self.remaining_cooldown()
+        if remaining:
+            logging.info("ArticleMeta circuit open, waiting %.0f s", remaining)
+            time.sleep(remaining)
+
+    def acquire(self):
+        """
+        Waits for a free slot and returns the timeout of the request.
+        """
+        with self._condition:
+            while True:
+                if self.opened_at is not None:
+                    if self.remaining_cooldown():
+                        raise CircuitOpen("ArticleMeta is unhealthy")
+                    if not self._trial:
+                        # half open: a trial request
+                        self._trial = True
+                        break
+                    # the others wait for the result of the trial
+                elif self._in_flight < self.limit:
+                    break
+                self._condition.wait()
+            self._in_flight += 1
+            return self.current_timeout
+
+    def release(self, latency, ok):
+        with self._condition:
+            self._in_flight -= 1
+            if ok:
+                self.latency = (
+                    latency
+                    if self.latency is None
+                    else 0.8 * self.latency + 0.2 * latency
+                )
+            ok = ok and latency <= self.slow_seconds
+            self._outcomes.append(ok)
+            if ok:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    self.limit = min(self.limit + 1, self.max_concurrency)
+            else:
+                self._successes = 0
+                self.limit = max(self.limit // 2, 1)
+            self._update_circuit(ok)
+            metrics.ARTICLEMETA_CONCURRENCY.set(self.limit)
+            self._condition.notify_all()
+
+    def _update_circuit(self, ok):
+        if self._trial:
+            self._trial = False
+            if ok:
+                logging.info("ArticleMeta circuit closed")
+                self.opened_at = None
+                self._outcomes.clear()
+            else:
+                self.opened_at = time.time()
+        elif self.opened_at is None and len(self._outcomes) == self._outcomes.maxlen:
+            failures = self._outcomes.count(False)
+            if failures >= self.error_rate * len(self._outcomes):
+                logging.warning(
+                    "ArticleMeta circuit open: %i of the last %i requests failed",
+                    failures,
+                    len(self._outcomes),
+                )
+                self.opened_at = time.time()
+        metrics.ARTICLEMETA_CIRCUIT_OPEN.set(0 if self.opened_at is None else 1)
+
+    @contextlib.contextmanager
+    def request(self):
+        """
+        Context of a request, which receives its timeout. Exceptions count
+        as failures.
+        """
+        timeout = self.acquire()
+        started = time.time()
+        ok = False
+        try:
+            yield timeout
+            ok = True
+        finally:
+            self.release(time.time() - started, ok)
+
+
 class XMLValidator(object):
 
-    def __init__(self):
-        xsd_filename = os.path.abspath(
-            os.path.join(os.path.dirname(__file__), "xsd/Clarivate_publishing.xsd")
+    def __init__(
+        self,
+        pool_size=10,
+        max_retries=3,
+        timeout=30,
+        xsd_filename=None,
+        structural_checks=True,
+        articlemeta_url=None,
+        throttle=None,
+        report_errors=True,
+    ):
+        """
+        ``throttle`` is the AdaptiveThrottle of the ArticleMeta requests.
+        Unless ``report_errors``, the errors found are not written with
+        ArticleReport.
+        """
+        self.xsd_filename = xsd_filename or XSD_FILENAME
+        self.structural_checks = structural_checks
+        self.report_errors = report_errors
+        self.articlemeta_url = (
+            articlemeta_url or "http://articlemeta.scielo.org/api/v1/article"
         )
-        self.validator = XMLValidatorWithSchema(xsd_filename)
-        self.articlemeta_url = "http://articlemeta.scielo.org/api/v1/article"
+        self.timeout = timeout
+        self.throttle = throttle or AdaptiveThrottle(pool_size, timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.fetched_bytes = 0
+        self._fetched_lock = threading.Lock()
+        self._validators = threading.local()
+
+    @property
+    def validator(self):
+        """
+        XMLValidatorWithSchema of the current thread, compiled when it
+        validates its first payload. An lxml XMLSchema keeps the errors of
+        its last validation, so it can not be shared among threads.
+        """
+        validator = getattr(self._validators, "validator", None)
+        if validator is None:
+            validator = XMLValidatorWithSchema(self.xsd_filename)
+            self._validators.validator = validator
+        return validator
 
-    def _get_xml(self, collection, code):
+    @lazy_property
+    def session(self):
+        return articlemeta_session(self.pool_size, self.max_retries)
+
+    @property
+    def connection_stats(self):
+        """
+        Number of requests sent to ArticleMeta, connections opened to serve
+        them and requests which reused an already open connection.
+        """
+        stats = {"requests": 0, "connections": 0}
+        if "session" not in self.__dict__:
+            # no request was sent
+            stats["reused"] = 0
+            return stats
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                stats["requests"] += pool.num_requests
+                stats["connections"] += pool.num_connections
+        stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+        return stats
+
+    def get_xml(self, collection, code):
+        """
+        Returns the xmlwos of the document. Raises ``requests.HTTPError`` for
+        the responses other than 2xx; the 5xx and 429 ones count as failures
+        of ArticleMeta for the throttle.
+        """
         params = {"collection": collection, "code": code, "format": "xmlwos"}
-        return requests.get(self.articlemeta_url, params=params, timeout=30).text
+        with self.throttle.request() as timeout:
+            response = self.session.get(
+                self.articlemeta_url, params=params, timeout=timeout
+            )
+            if response.status_code >= 500 or response.status_code == 429:
+                response.raise_for_status()
+        if not 200 <= response.status_code < 300:
+            raise requests.HTTPError(
+                "%s %s" % (response.status_code, response.reason), response=response
+            )
+        with self._fetched_lock:
+            self.fetched_bytes += len(response.content)
+        metrics.DOCUMENTS_FETCHED.inc()
+        metrics.FETCHED_BYTES.inc(len(response.content))
+        return response.text
 
     def validated_xml(self, textxml):
         validated = ValidatedXML(textxml)
         validated.validate(self.validator)
         return validated
 
-    def validate_xml(self, collection, code):
-        textxml = self._get_xml(collection, code)
-
-        validated_xml = self.validated_xml(textxml)
+    def validate_payload(self, collection, code, textxml):
+        """
+        Validates the xmlwos ``textxml`` of the document ``code`` and records
+        the errors found with ArticleReport, if ``report_errors``.
+        Returns the ValidatedXML instance.
+        """
+        rejected = precheck_payload(textxml, self.structural_checks)
+        if rejected is not None:
+            validated_xml = ValidatedXML(textxml, rejected=rejected)
+        else:
+            validated_xml = self.validated_xml(textxml)
 
-        if validated_xml.errors:
+        if validated_xml.errors and rejected is None:
             removed, textxml = remove_contrib_id(textxml)
             if removed:
                 validated_xml = self.validated_xml(textxml)
 
-        article_report = ArticleReport(
-            self.articlemeta_url, collection, code, XML_ERRORS_ROOT_PATH
-        )
-        article_report.save(validated_xml)
+        if self.report_errors:
+            article_report = ArticleReport(
+                self.articlemeta_url, collection, code, XML_ERRORS_ROOT_PATH
+            )
+            article_report.save(validated_xml)
+        return validated_xml
+
+    def validate_xml(self, collection, code):
+        textxml = self.get_xml(collection, code)
+
+        validated_xml = self.validate_payload(collection, code, textxml)
         if validated_xml.errors is None or len(validated_xml.errors) == 0:
             return validated_xml.tree
 
 
+# XMLValidator of the current ValidationPool worker process
+_worker_validator = None
+
+
+def _init_validation_worker(xsd_filename, report_errors):
+    global _worker_validator
+    _worker_validator = XMLValidator(
+        pool_size=1, xsd_filename=xsd_filename, report_errors=report_errors
+    )
+
+
+def _validate_in_worker(payload):
+    collection, code, textxml = payload
+    try:
+        validated_xml = _worker_validator.validate_payload(collection, code, textxml)
+        if validated_xml.errors:
+            return code, None, list(validated_xml.errors)
+        return code, article_fragment(validated_xml.tree), []
+    except Exception:
+        logging.exception("tools._validate_in_worker(%s)", code)
+        return code, None, None
+
+
+class ValidationPool(object):
+    """
+    Parses and validates xmlwos payloads against the Clarivate schema in
+    ``processes`` worker processes. Each worker compiles the schema once.
+    """
+
+    def __init__(self, processes, xsd_filename=None, report_errors=True):
+        self.processes = processes
+        self._pool = multiprocessing.Pool(
+            processes,
+            initializer=_init_validation_worker,
+            initargs=(xsd_filename or XSD_FILENAME, report_errors),
+        )
+
+    def imap(self, payloads):
+        """
+        Validates ``(collection, code, textxml)`` payloads.
+        Yields ``(code, fragment, errors)`` in the order of ``payloads``, where
+        ``fragment`` is the serialized ``<article>`` of a valid document and
+        ``None`` otherwise, and ``errors`` is ``None`` if it could not be
+        validated.
+        """
+        return self._pool.imap(_validate_in_worker, payloads)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
 class XML(object):
 
-    def __init__(self, textxml):
+    def __init__(self, textxml, parser="payload"):
         self.parse_errors = []
         self.text = textxml
+        self.parser = parser
         self._parse_xml()
 
     def _parse_xml(self):
-        xml = StringIO(self.text)
         self.tree = None
         try:
-            self.tree = etree.parse(xml)
+            self.tree = parse_xml(self.text, self.parser)
         except etree.XMLSyntaxError as e:
             self.parse_errors.append(e.message)
         except Exception as e:
-            msg = "tools.XML._parse_xml(): Unknown error. "
-            logging.exception(msg, e)
+            msg = PARSER_FAILURE
+            logging.exception("%s%s", msg, e)
             self.parse_errors.append(msg)
 
     @property
@@ -514,38 +1870,44 @@ class XMLValidatorWithSchema(object):
                 schema_doc = etree.parse(str_schema)
                 self._xml_schema = etree.XMLSchema(schema_doc)
         except (IOError, ValueError, etree.XMLSchemaError) as e:
-            logging.exception("tools.XMLValidatorWithSchema.xml_schema", e)
+            logging.exception("tools.XMLValidatorWithSchema.xml_schema: %s", e)
 
     def validate(self, tree):
         if self.xml_schema is None:
-            return "XMLSchema is not loaded"
+            return SCHEMA_NOT_LOADED
 
         try:
             self.xml_schema.validate(tree)
         except etree.XMLSyntaxError as e:
             return e.message
         except Exception as e:
-            logging.exception("tools.XMLValidatorWithSchema.validate", e)
+            logging.exception("tools.XMLValidatorWithSchema.validate: %s", e)
 
         try:
             self.xml_schema.assertValid(tree)
         except etree.DocumentInvalid as e:
             return e.message
         except Exception as e:
-            logging.exception("tools.XMLValidatorWithSchema.assertValid", e)
+            logging.exception("tools.XMLValidatorWithSchema.assertValid: %s", e)
 
 
 class ValidatedXML(object):
 
-    def __init__(self, textxml):
+    def __init__(self, textxml, rejected=None):
+        """
+        ``rejected`` is the reason to reject ``textxml`` without parsing it.
+        """
         self._errors = []
         self._original_xml = None
         self._pretty_xml = None
+        self._text = textxml
         if textxml is None:
-            self.errors = ["Empty XML"]
+            self.errors = [EMPTY_XML]
+        elif rejected is not None:
+            self.errors = rejected
         else:
             self._original_xml = XML(textxml)
-            self._pretty_xml = XML(self._original_xml.pretty_text)
+            self._pretty_xml = XML(self._original_xml.pretty_text, parser="pretty")
             self.errors = self._pretty_xml.parse_errors
 
     @property
@@ -583,6 +1945,7 @@ class ValidatedXML(object):
                     ]
                 )
             return self._original_xml.pretty_text
+        return self._text or ""
 
 
 class ArticleReport(object):
@@ -601,7 +1964,12 @@ class ArticleReport(object):
         issn = self.code[1:10]
         path = "{}/{}/{}".format(self.xml_error_root_path, self.collection, issn)
         if not os.path.isdir(path):
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created meanwhile by another validation thread
+                if not os.path.isdir(path):
+                    raise
         return path
 
     def save(self, validated, numbered=False):
@@ -628,12 +1996,59 @@ class DataHandler(object):
         mongodb_port=27017,
         mongodb_database="articlemeta",
         mongodb_collection="articles",
+        batch_size=100,
+        read_preference=None,
+        read_pool_size=100,
+        max_staleness_seconds=None,
     ):
+        """
+        The client connects and the indexes are ensured when the collections
+        are first used.
+
+        Given a ``read_preference`` (e.g. ``secondaryPreferred``), the scans
+        and counts go through a client of their own, with ``read_pool_size``
+        connections and ``max_staleness_seconds`` (at least 90), while the
+        writes go to the primary.
+        """
+        self.mongodb_host = mongodb_host
+        self.mongodb_database = mongodb_database
+        self.batch_size = batch_size
+        self.read_preference = read_preference
+        self.read_pool_size = read_pool_size
+        self.max_staleness_seconds = max_staleness_seconds
+
+    @lazy_property
+    def db(self):
+        return MongoClient(self.mongodb_host)[self.mongodb_database]
+
+    @lazy_property
+    def read_db(self):
+        if self.read_preference is None:
+            return self.db
+        options = {
+            "readPreference": self.read_preference,
+            "maxPoolSize": self.read_pool_size,
+        }
+        if self.max_staleness_seconds is not None:
+            options["maxStalenessSeconds"] = self.max_staleness_seconds
+        return MongoClient(self.mongodb_host, **options)[self.mongodb_database]
+
+    @lazy_property
+    def _articles_coll(self):
+        return self._set_articles_coll(self.db)
+
+    @lazy_property
+    def _collections_coll(self):
+        return self._set_collections_coll(self.db)
 
-        db = MongoClient(mongodb_host)[mongodb_database]
+    @lazy_property
+    def _articles_read_coll(self):
+        # the indexes are ensured through the primary
+        return self.read_db[self._articles_coll.name]
 
-        self._articles_coll = self._set_articles_coll(db)
-        self._collections_coll = self._set_collections_coll(db)
+    @lazy_property
+    def _collections_read_coll(self):
+        return self.read_db[self._collections_coll.name]
 
     def _set_articles_coll(self, db):
 
@@ -641,6 +2056,9 @@ class DataHandler(object):
         coll.ensure_index("publication_year")
         coll.ensure_index("sent_wos")
         coll.ensure_index("applicable")
+        # serve the filters of _find_documents already in _id order
+        coll.ensure_index([("code_title", ASCENDING), ("_id", ASCENDING)])
+        coll.ensure_index([("sent_wos", ASCENDING), ("_id", ASCENDING)])
 
         return coll
 
@@ -651,50 +2069,149 @@ class DataHandler(object):
 
         return coll
 
-    def load_pids_list_to_be_removed(self):
+    def _codes_by_code_title(self, issns):
+        """
+        Yields the code of the articles of ``issns`` from a single aggregation.
+        """
+        pipeline = [
+            {"$match": {"code_title": {"$in": list(issns)}}},
+            {"$project": {"_id": 0, "code": 1}},
+        ]
+        for reg in self._articles_read_coll.aggregate(
+            pipeline, allowDiskUse=True, batchSize=self.batch_size
+        ):
+            yield reg["code"]
+
+    def load_pids_list_to_be_removed(self, buffer_size=1 << 20):
 
         now = datetime.now().isoformat()[0:10].replace("-", "")
 
         recorded_at = "controller/SCIELO_DEL_{0}.del".format(now)
 
         toremove = []
+        issns = []
+        pids = []
 
-        with open(recorded_at, "wb") as f:
-            for line in open("controller/takeoff.txt", "r"):
+        with open("controller/takeoff.txt", "r") as f:
+            for line in f:
                 sline = line.strip()
                 toremove.append(sline)
                 if len(sline) == 9:
-                    for reg in self._articles_coll.find(
-                        {"code_title": sline}, {"code": 1}
-                    ):
-                        f.write("SCIELO,{0},Y\r\n".format(reg["code"]))
-                else:
-                    f.write("SCIELO,{0},Y\r\n".format(sline))
-
-            f.close()
+                    issns.append(sline)
+                elif sline:
+                    pids.append(sline)
+
+        pids = CodeSet(pids, max([PID_WIDTH] + [len(pid) for pid in pids]))
+        issns = CodeSet(issns, ISSN_WIDTH)
+        with open(recorded_at, "wb", buffer_size) as f:
+            f.writelines("SCIELO,{0},Y\r\n".format(pid) for pid in pids)
+            if issns:
+                f.writelines(
+                    "SCIELO,{0},Y\r\n".format(code)
+                    for code in self._codes_by_code_title(issns)
+                    if code not in pids
+                )
 
         return toremove
 
     def sync_sent_documents(self, remove_origin=False):
 
-        with open("controller/validated_ids.txt", "r") as f:
-            for pid in f:
-                self._articles_coll.update(
-                    {"code": pid.strip()}, {"$set": {"sent_wos": "True"}}, multi=True
-                )
+        self.mark_documents_as_sent_to_wos(
+            CodeSet.from_file("controller/validated_ids.txt")
+        )
 
         if remove_origin:
             os.remove("controller/validated_ids.txt")
 
-    def mark_documents_as_sent_to_wos(self, pids):
-        for pid in pids:
-            self._articles_coll.update(
-                {"code": pid}, {"$set": {"sent_wos": "True"}}, multi=True
+    def mark_documents_as_sent_to_wos(self, pids, chunk_size=1000):
+        """
+        Marks ``pids`` as sent, ``chunk_size`` PIDs per update, skipping the
+        articles already marked.
+        """
+        pids = iter(pids)
+        while True:
+            chunk = list(itertools.islice(pids, chunk_size))
+            if not chunk:
+                break
+            with metrics.MONGODB_QUERY_SECONDS.time(operation="mark_sent"):
+                self._articles_coll.update_many(
+                    {"code": {"$in": chunk}, "sent_wos": {"$ne": "True"}},
+                    {"$set": {"sent_wos": "True"}},
+                )
+
+    def quarantine_documents(self, rejections):
+        """
+        Quarantines the articles of ``rejections``, ``(document, checksum,
+        errors)`` items, recording the checksum of their payload, the
+        signature of their errors and their processing date.
+        They are not selected by ``not_sent`` until their processing date
+        changes.
+        """
+        now = datetime.now().isoformat()
+        updates = [
+            UpdateOne(
+                {"_id": document["_id"]},
+                {
+                    "$set": {
+                        "wos_quarantine": {
+                            "processing_date": document.get("processing_date"),
+                            "payload_md5": checksum,
+                            "errors_signature": errors_signature(errors),
+                            "errors": len(errors),
+                            "quarantined_at": now,
+                        }
+                    }
+                },
             )
+            for document, checksum, errors in rejections
+        ]
+        if updates:
+            with metrics.MONGODB_QUERY_SECONDS.time(operation="quarantine"):
+                self._articles_coll.bulk_write(updates, ordered=False)
+
+    def record_exports(self, exports, chunk_size=1000):
+        """
+        Records in the export ledger of the articles of ``exports``, ``(_id,
+        checksum)`` items, the checksum of the ``<article>`` delivered and
+        when.
+        """
+        now = datetime.now().isoformat()
+        exports = iter(exports)
+        while True:
+            chunk = list(itertools.islice(exports, chunk_size))
+            if not chunk:
+                break
+            updates = [
+                UpdateOne(
+                    {"_id": _id},
+                    {"$set": {"wos_export": {"md5": checksum, "sent_at": now}}},
+                )
+                for _id, checksum in chunk
+            ]
+            with metrics.MONGODB_QUERY_SECONDS.time(operation="record_exports"):
+                self._articles_coll.bulk_write(updates, ordered=False)
+
+    @staticmethod
+    def is_exported(document, checksum):
+        """
+        Returns whether the ``<article>`` of ``document`` with ``checksum`` is
+        the one recorded as delivered by the export ledger.
+        """
+        return (document.get("wos_export") or {}).get("md5") == checksum
+
+    @staticmethod
+    def is_quarantined(document):
+        """
+        Returns whether ``document`` is quarantined and was not processed
+        again since then.
+        """
+        quarantine = document.get("wos_quarantine") or {}
+        processing_date = document.get("processing_date")
+        return bool(quarantine) and quarantine.get("processing_date") == processing_date
 
     def load_collections_metadata(self):
 
-        collections = self._collections_coll.find()
+        collections = self._collections_read_coll.find()
 
         dict_collections = {}
         for collection in collections:
@@ -708,39 +2225,140 @@ class DataHandler(object):
             {"$set": {"applicable": "True"}},
         )
 
-    def not_sent(self, wos_collections_allowed, code_title=None, publication_year=1800):
-        """
-        Implements an iterable article PID list not validated on SciELO.
-        sent_wos = False
+    def _find_documents(self, fltr, batch_size=None, after_id=None):
         """
+        Yields ``[total, i, document]`` for the articles matching ``fltr``.
 
+        The articles are streamed in ``_id`` order from a no-timeout cursor
+        which fetches ``batch_size`` articles at a time, so memory does not
+        grow with the number of articles. If the cursor is lost, the query is
+        resumed after the last ``_id`` yielded (or ``after_id``).
+        """
+        batch_size = batch_size or self.batch_size
+        with metrics.MONGODB_QUERY_SECONDS.time(operation="count"):
+            total = self._articles_read_coll.count_documents(fltr)
+        i = 0
+        while True:
+            query = dict(fltr)
+            if after_id is not None:
+                query["_id"] = {"$gt": after_id}
+            cursor = (
+                self._articles_read_coll.find(
+                    query, {"citations": 0}, no_cursor_timeout=True
+                )
+                .sort("_id", ASCENDING)
+                .batch_size(batch_size)
+            )
+            try:
+                for document in cursor:
+                    i += 1
+                    after_id = document["_id"]
+                    logging.debug(
+                        "Selected document: %s %s",
+                        document["collection"],
+                        document["code"],
+                    )
+                    yield [total, i, document]
+                return
+            except CursorNotFound:
+                logging.info("Cursor lost, resuming after _id %s" % after_id)
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def not_sent_filter(
+        wos_collections_allowed,
+        code_title=None,
+        publication_year=1800,
+        quarantined=False,
+    ):
+        """
+        Unless ``quarantined``, excludes the articles quarantined which were
+        not processed again since then.
+        """
         fltr = {
             "sent_wos": "False",
             "applicable": "True",
             "collection": {"$in": wos_collections_allowed},
             "publication_year": {"$gte": str(publication_year)},
         }
+        if code_title:
+            fltr.update({"code_title": code_title})
+        if not quarantined:
+            fltr["$or"] = [
+                {"wos_quarantine": {"$exists": False}},
+                {
+                    "$expr": {
+                        "$ne": ["$wos_quarantine.processing_date", "$processing_date"]
+                    }
+                },
+            ]
+        return fltr
 
+    @staticmethod
+    def sent_to_wos_filter(code_title=None):
+        fltr = {"sent_wos": "True"}
         if code_title:
             fltr.update({"code_title": code_title})
-        logging.debug("Select documents: %s" % str(fltr))
-        documents = []
-        total = 0
-        for document in self._articles_coll.find(fltr, {"collection": 1, "code": 1}):
-            total += 1
-            documents.append([document["collection"], document["code"]])
+        return fltr
 
-        i = 0
-        for document in documents:
-            i = i + 1
-            logging.debug("Selected document: %s" % str(document))
-            yield [
-                total,
-                i,
-                self._articles_coll.find_one(
-                    {"collection": document[0], "code": document[1]}, {"citations": 0}
-                ),
-            ]
+    def count_by_code_title(self, fltr, issns):
+        """
+        Returns the number of articles matching ``fltr`` for each one of
+        ``issns`` with a single aggregation.
+        """
+        issns = list(issns)
+        match = dict(fltr)
+        match["code_title"] = {"$in": issns}
+        pipeline = [
+            {"$match": match},
+            {"$project": {"code_title": 1}},
+            {"$unwind": "$code_title"},
+            {"$match": {"code_title": {"$in": issns}}},
+            {"$group": {"_id": "$code_title", "total": {"$sum": 1}}},
+        ]
+        counts = dict.fromkeys(issns, 0)
+        with metrics.MONGODB_QUERY_SECONDS.time(operation="count_by_code_title"):
+            for item in self._articles_read_coll.aggregate(pipeline, allowDiskUse=True):
+                counts[item["_id"]] = item["total"]
+        return counts
+
+    def watch_articles(self, fltr, resume_after=None, max_await_time_ms=1000):
+        """
+        Returns a change stream of the inserted, updated or replaced articles
+        whose current version matches ``fltr``, without their citations.
+        ``try_next`` returns ``None`` after ``max_await_time_ms`` without
+        changes. Requires MongoDB running as a replica set.
+        """
+        match = {"operationType": {"$in": ["insert", "update", "replace"]}}
+        for key, value in fltr.items():
+            match["fullDocument." + key] = value
+        pipeline = [{"$match": match}, {"$project": {"fullDocument.citations": 0}}]
+        return self._articles_read_coll.watch(
+            pipeline,
+            full_document="updateLookup",
+            resume_after=resume_after,
+            max_await_time_ms=max_await_time_ms,
+            batch_size=self.batch_size,
+        )
+
+    def not_sent(
+        self,
+        wos_collections_allowed,
+        code_title=None,
+        publication_year=1800,
+        quarantined=False,
+    ):
+        """
+        Implements an iterable article PID list not validated on SciELO.
+        sent_wos = False
+        """
+
+        fltr = self.not_sent_filter(
+            wos_collections_allowed, code_title, publication_year, quarantined
+        )
+        logging.debug("Select documents: %s" % str(fltr))
+        return self._find_documents(fltr)
 
     def sent_to_wos(self, code_title=None):
         """
@@ -748,27 +2366,9 @@ class DataHandler(object):
         sent_wos = True
         """
 
-        fltr = {"sent_wos": "True"}
-
-        if code_title:
-            fltr.update({"code_title": code_title})
-
-        documents = []
-        total = 0
-        for document in self._articles_coll.find(fltr, {"code": 1, "collection": 1}):
-            total += 1
-            documents.append([document["collection"], document["code"]])
+        fltr = self.sent_to_wos_filter(code_title)
 
-        i = 0
-        for document in documents:
-            i += 1
-            yield [
-                total,
-                i,
-                self._articles_coll.find_one(
-                    {"collection": document[0], "code": document[1]}, {"citations": 0}
-                ),
-            ]
+        return self._find_documents(fltr)
 
     def not_sent_with_proc_date(
         self,
@@ -776,44 +2376,23 @@ class DataHandler(object):
         code_title=None,
         processing_date=None,
         publication_year=1800,
+        quarantined=False,
     ):
         """
         Implements an iterable article PID list not validated on SciELO.
         sent_wos = False
         """
 
-        fltr = {
-            "sent_wos": "False",
-            "applicable": "True",
-            "collection": {"$in": wos_collections_allowed},
-            "publication_year": {"$gte": str(publication_year)},
-        }
-
-        if code_title:
-            fltr.update({"code_title": code_title})
+        fltr = self.not_sent_filter(
+            wos_collections_allowed, code_title, publication_year, quarantined
+        )
         if processing_date:
             _processing_date = earlier_datetime(processing_date)
             fltr.update({"processing_date": {"$gte": _processing_date}})
 
         logging.debug("Select documents: %s" % str(fltr))
 
-        documents = []
-        total = 0
-        for document in self._articles_coll.find(fltr, {"collection": 1, "code": 1}):
-            total += 1
-            documents.append([document["collection"], document["code"]])
-
-        i = 0
-        for document in documents:
-            i = i + 1
-            logging.debug("Selected document: %s" % str(document))
-            yield [
-                total,
-                i,
-                self._articles_coll.find_one(
-                    {"collection": document[0], "code": document[1]}, {"citations": 0}
-                ),
-            ]
+        return self._find_documents(fltr)
 
     def sent_to_wos_with_proc_date(self, code_title=None, processing_date=None):
         """
@@ -821,26 +2400,9 @@ class DataHandler(object):
         sent_wos = True
         """
 
-        fltr = {"sent_wos": "True"}
-        if code_title:
-            fltr.update({"code_title": code_title})
+        fltr = self.sent_to_wos_filter(code_title)
         if processing_date:
             _processing_date = earlier_datetime(processing_date)
             fltr.update({"processing_date": {"$gte": _processing_date}})
 
-        documents = []
-        total = 0
-        for document in self._articles_coll.find(fltr, {"collection": 1, "code": 1}):
-            total += 1
-            documents.append([document["collection"], document["code"]])
-
-        i = 0
-        for document in documents:
-            i += 1
-            yield [
-                total,
-                i,
-                self._articles_coll.find_one(
-                    {"collection": document[0], "code": document[1]}, {"citations": 0}
-                ),
-            ]
+        return self._find_documents(fltr)
@@ -2,8 +2,22 @@
 import os
 from datetime import datetime, timedelta
 import weakref
+import logging
+import threading
+import contextlib
+import cProfile
 
 from ConfigParser import SafeConfigParser
+from Queue import Queue
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4 without the pytracemalloc backport
+    tracemalloc = None
+
+
+logger = logging.getLogger(__name__)
 
 
 def _yyyymmdd_to_datetime(YYYYMMDD):
@@ -84,4 +98,113 @@ class Configuration(SingletonMixin):
         """Settings as key-value pair.
         """
         return [(section, dict(self.conf.items(section))) for \
-            section in [section for section in self.conf.sections()]]
\ No newline at end of file
+            section in [section for section in self.conf.sections()]]
+
+class lazy_property(object):
+    """
+    Property computed on its first access and then stored in the instance,
+    e.g. for connections and parsers which are expensive to create and may
+    not be used at all.
+    """
+    _lock = threading.RLock()
+
+    def __init__(self, method):
+        self.method = method
+        self.name = method.__name__
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with self._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.method(instance)
+        return instance.__dict__[self.name]
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands the log records to ``handler`` in a background thread, so that
+    logging calls do not wait for the records to be written.
+
+    At most ``capacity`` records are buffered; when the buffer is full the
+    logging calls block until the thread catches up.
+    """
+    def __init__(self, handler, capacity=10000):
+        logging.Handler.__init__(self, handler.level)
+        self.handler = handler
+        self._queue = Queue(capacity)
+        self._thread = threading.Thread(
+            target=self._consume, name='logging-%s' % type(handler).__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            # the message is formatted here, as its arguments may change
+            # before the record is written
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self._queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def _consume(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+@contextlib.contextmanager
+def profiling(name, profile=False, trace_memory=False, top=25):
+    """
+    Profiles the block with cProfile, dumping ``<name>.pstats``, and traces
+    its memory allocations with tracemalloc, writing the ``top`` allocations
+    to ``<name>.memory.txt``.
+    """
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+    if trace_memory and tracemalloc is None:
+        logger.warning('tracemalloc is not available, memory is not traced')
+        trace_memory = False
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(name + '.pstats')
+            logger.info('Profile written to %s.pstats', name)
+        if trace_memory:
+            _write_memory_snapshot(name + '.memory.txt', top)
+            if started_tracing:
+                tracemalloc.stop()
+
+
+def _write_memory_snapshot(filename, top):
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    with open(filename, 'w') as fp:
+        fp.write('current: %i bytes, peak: %i bytes\n\n' % (current, peak))
+        for stat in snapshot.statistics('lineno')[:top]:
+            fp.write('%s\n' % stat)
+    logger.info('Memory allocations written to %s', filename)